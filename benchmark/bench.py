@@ -0,0 +1,280 @@
+#!/usr/bin/python
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: benchmark ldapsmb account operations against a throwaway slapd
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## A slapd with the samba schema is started on 127.0.0.1 in a temporary
+## directory, populated with do_population and every operation is timed
+## at each scale. Results are written as JSON, --compare prints the
+## speedup of a run against an earlier one.
+##
+## example: benchmark/bench.py --scales 1000,10000 --output run.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import signal
+import getpass
+import optparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ldapAccount
+
+SUFFIX   = 'dc=bench,dc=local'
+ROOTDN   = 'cn=admin,' + SUFFIX
+PASSWORD = 'bench'
+DOMAIN   = 'BENCH'
+SID      = 'S-1-5-21-1000-2000-3000'
+
+SCHEMA_DIRS = ['/etc/ldap/schema', '/etc/openldap/schema',
+               '/usr/local/etc/openldap/schema']
+SAMBA_SCHEMAS = ['/etc/ldap/schema/samba.schema',
+                 '/etc/openldap/schema/samba.schema',
+                 '/usr/share/doc/samba/examples/LDAP/samba.schema',
+                 '/usr/share/samba/samba.schema']
+MODULE_DIRS = ['/usr/lib/ldap', '/usr/lib64/openldap', '/usr/lib/openldap',
+               '/usr/libexec/openldap', '/usr/local/libexec/openldap']
+
+SLAPD_CONF = '''include %(schemas)s/core.schema
+include %(schemas)s/cosine.schema
+include %(schemas)s/inetorgperson.schema
+include %(schemas)s/nis.schema
+include %(samba)s
+
+pidfile %(dir)s/slapd.pid
+%(modules)s
+
+database mdb
+maxsize 4294967296
+suffix "%(suffix)s"
+rootdn "%(rootdn)s"
+rootpw %(password)s
+directory %(dir)s/data
+sizelimit unlimited
+
+index objectClass eq
+index uid,cn,memberUid eq
+index uidNumber,gidNumber eq
+index sambaSID,sambaDomainName eq
+'''
+
+LDAPSMB_CONF = '''[ldap]
+uri    = %(uri)s
+binddn = %(rootdn)s
+passwd = %(password)s
+usetls = false
+
+[samba]
+ldap suffix         = %(suffix)s
+ldap user suffix    = ou=users
+ldap group suffix   = ou=groups
+ldap machine suffix = ou=computers
+sambaDomain         = %(domain)s
+sambaSID            = %(sid)s
+
+[posix]
+homeDirPath      = /home
+defaultGidNumber = 513
+defaultShell     = /bin/bash
+
+[cache]
+ttl = 0
+'''
+
+def find(paths, what):
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    raise SystemExit('%s not found, tried: %s' % (what, ', '.join(paths)))
+
+def freePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+class Slapd(object):
+    '''slapd with an empty database in a temporary directory'''
+    def __init__(self, options):
+        self.dir  = tempfile.mkdtemp(prefix='ldapsmb-bench-')
+        self.port = freePort()
+        self.uri  = 'ldap://127.0.0.1:%d' % self.port
+        os.mkdir(os.path.join(self.dir, 'data'))
+
+        # back_mdb is a loadable module on most distributions
+        modules   = ''
+        moduleDir = options.modules
+        if not moduleDir:
+            found = [d for d in MODULE_DIRS
+                     if os.path.exists(os.path.join(d, 'back_mdb.la'))]
+            moduleDir = found and found[0]
+        if moduleDir:
+            modules = 'modulepath %s\nmoduleload back_mdb' % moduleDir
+
+        conf = os.path.join(self.dir, 'slapd.conf')
+        f = open(conf, 'w')
+        f.write(SLAPD_CONF % {
+            'schemas': options.schemas or find(SCHEMA_DIRS, 'schema directory'),
+            'samba': options.sambaSchema or find(SAMBA_SCHEMAS, 'samba.schema'),
+            'modules': modules, 'dir': self.dir, 'suffix': SUFFIX,
+            'rootdn': ROOTDN, 'password': PASSWORD })
+        f.close()
+
+        slapd = options.slapd or find(['/usr/sbin/slapd', '/usr/libexec/slapd',
+                                       '/usr/local/libexec/slapd'], 'slapd')
+        # -d 0 keeps slapd in the foreground, so it can be stopped reliably
+        self.process = subprocess.Popen([slapd, '-f', conf, '-h', self.uri, '-d', '0'])
+
+        for i in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                return
+            except socket.error, e:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+        self.stop()
+        raise SystemExit('slapd did not start, see %s' % conf)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+        shutil.rmtree(self.dir, True)
+
+class Timer(object):
+    '''Collect the latency of every call of one operation'''
+    def __init__(self, operation, scale):
+        self.operation = operation
+        self.scale     = scale
+        self.latencies = []
+
+    def run(self, function, *args, **kwargs):
+        start = time.time()
+        function(*args, **kwargs)
+        self.latencies.append(time.time() - start)
+
+    def percentile(self, latencies, p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        total     = sum(latencies)
+        return { 'operation': self.operation,
+                 'scale': self.scale,
+                 'count': len(latencies),
+                 'seconds': round(total, 3),
+                 'ops_per_sec': round(len(latencies) / total, 1) if total else None,
+                 'p50_ms': round(self.percentile(latencies, 0.50) * 1000, 3),
+                 'p99_ms': round(self.percentile(latencies, 0.99) * 1000, 3) }
+
+def benchmark(scale, options):
+    '''Start a fresh slapd, populate it and time all operations at scale'''
+    slapd = Slapd(options)
+    cfg   = os.path.join(slapd.dir, 'ldapsmb.conf')
+    f = open(cfg, 'w')
+    f.write(LDAPSMB_CONF % { 'uri': slapd.uri, 'rootdn': ROOTDN,
+                             'password': PASSWORD, 'suffix': SUFFIX,
+                             'domain': DOMAIN, 'sid': SID })
+    f.close()
+
+    ldapAccount.cfgfile = cfg
+    # do_population asks for the root password
+    getpass.getpass = lambda prompt='': PASSWORD
+
+    stdout  = sys.stdout
+    results = []
+    try:
+        # account operations report every entry on stdout
+        sys.stdout = open(os.devnull, 'w')
+        ldapAccount.do_population(['ldapsmb', 'populate'])
+        acc = ldapAccount.Account(cfg)
+        acc.createPosixGroup('bench', None)
+
+        samba     = ['s%d' % i for i in range(scale)]
+        posix     = ['p%d' % i for i in range(scale)]
+        machines  = ['m%d' % i for i in range(scale)]
+        pmachines = ['pm%d' % i for i in range(scale)]
+
+        operations = [
+            ('createSambaUser', samba, lambda n: acc.createSambaUser(n)),
+            ('createPosixUser', posix, lambda n: acc.createPosixUser(n)),
+            ('changeUserPassword', samba, lambda n: acc.changeUserPassword(n, 'Secret-' + n)),
+            ('addUserToGroup', samba, lambda n: acc.addUserToGroup(n, 'bench')),
+            ('deleteUser', samba + posix, lambda n: acc.deleteUser(n)),
+            ('createSambaMachine', machines, lambda n: acc.createSambaMachine(n)),
+            ('createPosixMachine', pmachines, lambda n: acc.createPosixMachine(n)),
+            ('deleteMachine', machines + pmachines, lambda n: acc.deleteMachine(n)),
+        ]
+
+        for operation, names, function in operations:
+            if options.operations and operation not in options.operations:
+                continue
+            timer = Timer(operation, scale)
+            for name in names:
+                timer.run(function, name)
+            results.append(timer.result())
+            sys.stderr.write('%(operation)-20s %(scale)8d %(ops_per_sec)10s ops/s  '
+                         'p50 %(p50_ms)8.3f ms  p99 %(p99_ms)8.3f ms\n' % results[-1])
+    finally:
+        sys.stdout = stdout
+        slapd.stop()
+
+    return results
+
+def compare(old, new):
+    '''Print new ops/sec relative to an earlier run'''
+    before = dict(((r['operation'], r['scale']), r) for r in old['results'])
+
+    for r in new['results']:
+        o = before.get((r['operation'], r['scale']))
+        if o and o['ops_per_sec'] and r['ops_per_sec']:
+            print '%-20s %8d %8.2fx  p99 %8.3f -> %8.3f ms' % (
+                r['operation'], r['scale'], r['ops_per_sec'] / o['ops_per_sec'],
+                o['p99_ms'], r['p99_ms'])
+
+def main():
+    usage = '%prog [-h | --help] [Options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--scales", dest='scales', help='comma separated numbers of entries (default: 1000,10000,100000)', default='1000,10000,100000')
+    parser.add_option("--operations", dest='operations', help='comma separated operations to run (default: all)')
+    parser.add_option("-o", "--output", dest='output', help='write results as JSON to this file (default: stdout)')
+    parser.add_option("--compare", dest='compare', help='JSON results of an earlier run to compare with')
+    parser.add_option("--slapd", dest='slapd', help='slapd binary')
+    parser.add_option("--schemas", dest='schemas', help='directory with core, cosine, inetorgperson and nis schema')
+    parser.add_option("--samba-schema", dest='sambaSchema', help='samba.schema file')
+    parser.add_option("--modules", dest='modules', help='slapd module directory containing back_mdb')
+
+    (options, args) = parser.parse_args()
+
+    if options.operations:
+        options.operations = options.operations.split(',')
+
+    run = { 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'results': [] }
+    for scale in [int(s) for s in options.scales.split(',')]:
+        run['results'].extend(benchmark(scale, options))
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(run, f, indent=2)
+        f.close()
+    else:
+        json.dump(run, sys.stdout, indent=2)
+        print
+
+    if options.compare:
+        f = open(options.compare)
+        compare(json.load(f), run)
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: compare the pure python MD4 with hashlib's for NT hashes
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## example: benchmark/md4bench.py --count 100000
+
+import os
+import sys
+import time
+import hashlib
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ldapAccount import md4
+
+def run(name, function, passwords):
+    start = time.time()
+    for password in passwords:
+        function(password)
+    seconds = time.time() - start
+    print '%-10s %10d hashes %8.3f s %12.1f hashes/s' % (
+        name, len(passwords), seconds, len(passwords) / seconds)
+
+def main():
+    usage = '%prog [-h | --help] [Options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--count", dest='count', help='number of passwords to hash (default: 100000)', type='int', default=100000)
+    parser.add_option("--length", dest='length', help='password length (default: 12)', type='int', default=12)
+
+    (options, args) = parser.parse_args()
+
+    passwords = [('%0*d' % (options.length, i)).encode('utf-16le')
+                 for i in range(options.count)]
+
+    run('md4.py', md4.digest, passwords)
+
+    try:
+        hashlib.new('md4')
+    except ValueError:
+        print 'hashlib    no MD4 in this OpenSSL'
+        return
+
+    for password in passwords[:1000]:
+        if md4.digest(password) != hashlib.new('md4', password).digest():
+            raise SystemExit('md4.py and hashlib differ for %r' % password)
+    run('hashlib', lambda p: hashlib.new('md4', p).digest(), passwords)
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,11 @@ import sys
 import re
 import ldap
 import ldap.modlist
+import ldap.filter
+from ldap.controls import SimplePagedResultsControl
+import ldif
+import csv
+import collections
 import ConfigParser
 import optparse
 import getpass
@@ -27,6 +32,16 @@ import base64
 import hashlib
 import binascii
 import crypt
+import threading
+import json
+import errno
+import atexit
+import tempfile
+import zlib
+import shlex
+import multiprocessing
+import Queue
+import StringIO
 
 # path to configuration file
 cfgfile = "/etc/ldapsmb.conf"
@@ -34,6 +49,55 @@ cfgfile = "/etc/ldapsmb.conf"
 if os.path.exists( os.path.join(os.path.expanduser("~"), ".ldapsmb.conf" )):
     cfgfile = os.path.join(os.path.expanduser("~"), ".ldapsmb.conf" )
 
+try:
+    hashlib.new('md4')
+    def md4Digest(data):
+        return hashlib.new('md4', data).digest()
+except ValueError:
+    # OpenSSL 3 offers MD4 only with the legacy provider loaded
+    from ldapAccount.md4 import digest as md4Digest
+
+def createNTPassword(password):
+    hash = md4Digest(password.encode('utf-16le'))
+    return binascii.hexlify(hash)
+
+def createCryptPassword(password, digest='SSHA'):
+    digest = digest.upper()
+    crypt  = password
+    salt   = ''
+
+    for i in range(8):
+        salt += chr(random.randint(0, 255))
+
+    if digest == "SSHA":
+        crypt = "{SSHA}" + base64.encodestring(hashlib.sha1(password+salt).digest()+salt)
+    elif digest == "SHA":
+        crypt = "{SHA}" + base64.encodestring(hashlib.sha1(password).digest())
+    elif digest == "MD5":
+        crypt = "{MD5}" + base64.encodestring(hashlib.md5(password).digest())
+    elif digest == "CRYPT":
+        crypt = "{CRYPT}" + crypt.crypt(password, salt)
+
+    return crypt
+
+def _hashPassword(row):
+    '''Process pool worker computing the missing hashes of a row of a
+       password file. Only the hashes are sent back.'''
+    line, uid, password, ntpassword, cryptpassword = row
+    try:
+        if not ntpassword:
+            ntpassword = createNTPassword(password)
+        if not cryptpassword:
+            cryptpassword = createCryptPassword(password)
+    except Exception, e:
+        return line, uid, None, None, str(e)
+
+    return line, uid, ntpassword, cryptpassword, None
+
+class IdAllocationError(Exception):
+    '''Raised when no ID could be reserved on the sambaDomain entry'''
+    pass
+
 class Config(ConfigParser.ConfigParser):
     '''Provide configuration parameters from external config file'''
     def __init__(self, filename):
@@ -43,7 +107,7 @@ class Config(ConfigParser.ConfigParser):
     def getOption(self, section, option):
         try:
             return self.get(section, option)
-        except ConfigParser.NoOptionError, e:
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError), e:
             return None
 
     def getOp(self, section, option):
@@ -55,171 +119,1329 @@ class Config(ConfigParser.ConfigParser):
             for pairs in self.items(section):
                 print pairs
 
+class OperationStats(object):
+    '''Count and time the LDAP operations of the process. With trace set
+       to a file every operation is logged to it as it finishes.'''
+    operations = ('connect', 'starttls', 'bind', 'search', 'add', 'modify',
+                  'delete', 'modrdn')
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.counts  = dict.fromkeys(self.operations, 0)
+        self.errors  = dict.fromkeys(self.operations, 0)
+        self.seconds = dict.fromkeys(self.operations, 0.0)
+        self.trace   = None
+
+    def record(self, operation, seconds, target=None, error=None):
+        with self.lock:
+            self.counts[operation]  = self.counts.get(operation, 0) + 1
+            self.seconds[operation] = self.seconds.get(operation, 0.0) + seconds
+            if error is not None:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+        if self.trace:
+            line = '%9.3f ms %-8s %s' % (seconds * 1000, operation, target or '')
+            if error is not None:
+                line += ': ' + error.__class__.__name__
+            self.trace.write(line + '\n')
+
+    def timed(self, operation, target, function, *args, **kwargs):
+        '''Call function, recording its duration as one operation'''
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except ldap.LDAPError, e:
+            self.record(operation, time.time() - start, target, e)
+            raise
+        self.record(operation, time.time() - start, target)
+        return result
+
+    def totalErrors(self):
+        return sum(self.errors.values())
+
+    def summary(self, out):
+        out.write('%-9s %8s %7s %12s %10s\n' % ('operation', 'count', 'errors',
+                                                 'total ms', 'avg ms'))
+        for operation in sorted(self.counts):
+            count = self.counts[operation]
+            if not count:
+                continue
+            ms = self.seconds[operation] * 1000
+            out.write('%-9s %8d %7d %12.3f %10.3f\n' % (operation, count,
+                      self.errors[operation], ms, ms / count))
+
+    def prometheus(self):
+        '''The counters in the Prometheus text exposition format'''
+        lines = [
+            '# HELP ldapsmb_ldap_operations_total LDAP operations sent.',
+            '# TYPE ldapsmb_ldap_operations_total counter']
+        lines += ['ldapsmb_ldap_operations_total{operation="%s"} %d' % (o, c)
+                  for o, c in sorted(self.counts.items())]
+        lines += [
+            '# HELP ldapsmb_ldap_operation_errors_total LDAP operations which failed.',
+            '# TYPE ldapsmb_ldap_operation_errors_total counter']
+        lines += ['ldapsmb_ldap_operation_errors_total{operation="%s"} %d' % (o, c)
+                  for o, c in sorted(self.errors.items())]
+        lines += [
+            '# HELP ldapsmb_ldap_operation_seconds_total Time spent waiting for LDAP operations.',
+            '# TYPE ldapsmb_ldap_operation_seconds_total counter']
+        lines += ['ldapsmb_ldap_operation_seconds_total{operation="%s"} %.6f' % (o, s)
+                  for o, s in sorted(self.seconds.items())]
+        return '\n'.join(lines) + '\n'
+
+# operation counters of all LDAP connections of the process
+stats = OperationStats()
+
 class LDAP(object):
     '''LDAP connection'''
+    # entries per page of a paged search, 0 disables paging
+    pageSize = 500
+    stats    = stats
+
     def __init__(self, uri, binddn, passwd, usetls):
+        # asynchronous operations in flight: msgid -> (operation, dn, start)
+        self.submitted    = {}
         self.ldap_session = self.connect(uri, binddn, passwd, usetls)
 
     def connect(self, uri, binddn, passwd, usetls):
         ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-        session = ldap.initialize(uri)
+        # libldap connects on the first operation, the TCP (and ldaps TLS)
+        # handshake is counted by starttls or bind
+        session = self.stats.timed('connect', uri, ldap.initialize, uri)
 
         if usetls:
-            session.start_tls_s()
+            self.stats.timed('starttls', uri, session.start_tls_s)
 
-        session.simple_bind(binddn, passwd)
+        self.stats.timed('bind', binddn, session.simple_bind_s, binddn, passwd)
         return session
 
     def ldap_add(self, dn, attrs):
-        self.ldap_session.add_s(dn, attrs)
+        self.stats.timed('add', dn, self.ldap_session.add_s, dn, attrs)
 
     def ldap_del(self, dn):
-        self.ldap_session.delete_s(dn)
+        self.stats.timed('delete', dn, self.ldap_session.delete_s, dn)
+
+    def ldap_submit(self, operation, dn, msgid):
+        self.submitted[msgid] = (operation, dn, time.time())
+        return msgid
+
+    def ldap_add_async(self, dn, attrs):
+        return self.ldap_submit('add', dn, self.ldap_session.add(dn, attrs))
+
+    def ldap_modify_async(self, dn, attrs):
+        return self.ldap_submit('modify', dn, self.ldap_session.modify(dn, attrs))
+
+    def ldap_del_async(self, dn):
+        return self.ldap_submit('delete', dn, self.ldap_session.delete(dn))
+
+    def ldap_result(self, msgid, timeout=-1):
+        try:
+            result = self.ldap_session.result(msgid, 1, timeout)
+        except ldap.LDAPError, e:
+            operation, dn, start = self.submitted.pop(msgid, ('unknown', None, 0))
+            self.stats.record(operation, time.time() - start, dn, e)
+            raise
+
+        if result[0] is not None and msgid in self.submitted:
+            operation, dn, start = self.submitted.pop(msgid)
+            self.stats.record(operation, time.time() - start, dn)
+
+        return result
+
+    def ldap_pipeline(self, window=64, callback=None):
+        return Pipeline(self, window, callback)
 
     def ldap_search(self, basedn, filter, attributes, scope=ldap.SCOPE_SUBTREE):
-        result_id  = self.ldap_session.search(basedn, scope, filter, attributes)
-        type, result_list = self.ldap_session.result(result_id, 1)
-        return result_list
+        return list(self.ldap_search_iter(basedn, filter, attributes, scope))
+
+    def ldap_search_iter(self, basedn, filter, attributes,
+                         scope=ldap.SCOPE_SUBTREE, pageSize=None):
+        '''Yield (dn, attributes) of matching entries as they arrive,
+           requesting pageSize entries at a time with the Simple Paged
+           Results control (RFC 2696). Servers without paging support
+           return all entries in one page.'''
+        if pageSize is None:
+            pageSize = self.pageSize
+
+        controls = []
+        if pageSize:
+            paging   = SimplePagedResultsControl(False, size=pageSize, cookie='')
+            controls = [paging]
+
+        # only the time waiting for the server counts, not the caller's
+        waited = 0.0
+        error  = None
+
+        try:
+            while True:
+                start = time.time()
+                msgid = self.ldap_session.search_ext(basedn, scope, filter,
+                                                     attributes,
+                                                     serverctrls=controls)
+                waited += time.time() - start
+                finished = False
+                try:
+                    while True:
+                        start = time.time()
+                        rtype, rdata, rmsgid, rctrls = \
+                            self.ldap_session.result3(msgid, 0)
+                        waited += time.time() - start
+                        if rtype == ldap.RES_SEARCH_RESULT:
+                            finished = True
+                            break
+                        for dn, attrs in rdata:
+                            # skip search continuation references
+                            if dn is not None:
+                                yield dn, attrs
+                finally:
+                    # the caller stopped early, drop the rest of the search
+                    if not finished:
+                        self.ldap_session.abandon(msgid)
+
+                cookie = None
+                for control in rctrls:
+                    if control.controlType == SimplePagedResultsControl.controlType:
+                        cookie = control.cookie
+                if not cookie:
+                    break
+                paging.cookie = cookie
+        except ldap.LDAPError, e:
+            error = e
+            raise
+        finally:
+            self.stats.record('search', waited, '%s %s' % (basedn, filter),
+                              error)
+
+    def ldap_search_many(self, basedn, filters, attributes,
+                         scope=ldap.SCOPE_SUBTREE, window=8):
+        '''Yield (dn, attributes) of the entries matching any of filters,
+           keeping up to window searches outstanding at once. Meant for
+           small results: the searches are not paged.'''
+        filters = iter(filters)
+        pending = collections.deque()  # (msgid, filter, start)
+
+        try:
+            while True:
+                for filter in filters:
+                    msgid = self.ldap_session.search_ext(basedn, scope, filter,
+                                                         attributes)
+                    pending.append((msgid, filter, time.time()))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+
+                msgid, filter, start = pending.popleft()
+                target = '%s %s' % (basedn, filter)
+                try:
+                    rtype, rdata = self.ldap_session.result(msgid, 1)
+                except ldap.LDAPError, e:
+                    self.stats.record('search', time.time() - start, target, e)
+                    raise
+                self.stats.record('search', time.time() - start, target)
+
+                for dn, attrs in rdata:
+                    if dn is not None:
+                        yield dn, attrs
+        finally:
+            # stopped early or failed, drop what is still running
+            for msgid, filter, start in pending:
+                self.ldap_session.abandon(msgid)
+
+    def ldap_modify(self, dn, attrs):
+        self.stats.timed('modify', dn, self.ldap_session.modify_s, dn, attrs)
+
+    def ldap_rename(self, dn, newrdn):
+        '''Change the rdn of an entry, the old rdn value is removed'''
+        self.stats.timed('modrdn', dn, self.ldap_session.modrdn_s, dn, newrdn, 1)
 
     def ldap_update_attribute(self, dn, attribute, values):
         attrs = [(ldap.MOD_REPLACE, attribute, values)]
-        self.ldap_session.modify_s(dn, attrs)
+        self.ldap_modify(dn, attrs)
 
     def ldap_add_attribute(self, dn, attribute, values):
         attrs = [(ldap.MOD_ADD, attribute, values)]
-        self.ldap_session.modify_s(dn, attrs)
+        self.ldap_modify(dn, attrs)
 
     def ldap_del_attribute(self, dn, attribute, values):
         attrs = [(ldap.MOD_DELETE, attribute, values)]
-        self.ldap_session.modify_s(dn, attrs)
+        self.ldap_modify(dn, attrs)
+
+class Pipeline(object):
+    '''Keep up to window asynchronous add/modify/delete operations
+       outstanding on one LDAP connection.
+
+       callback(dn, tag, error) is called for every finished operation,
+       error is None on success or the LDAPError raised for that dn.
+       Results are taken oldest first: a connection's operations are
+       answered practically in order, and this maps every error to its dn
+       with any python-ldap version.'''
+    def __init__(self, ldapSession, window=64, callback=None):
+        self.session  = ldapSession
+        self.window   = max(1, int(window))
+        self.callback = callback
+        self.pending  = collections.deque()  # (msgid, dn, tag)
+        self.done     = 0
+        self.errors   = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, dn, attrs, tag=None):
+        self.submit(self.session.ldap_add_async(dn, attrs), dn, tag)
+
+    def modify(self, dn, attrs, tag=None):
+        self.submit(self.session.ldap_modify_async(dn, attrs), dn, tag)
+
+    def delete(self, dn, tag=None):
+        self.submit(self.session.ldap_del_async(dn), dn, tag)
+
+    def submit(self, msgid, dn, tag):
+        self.pending.append((msgid, dn, tag))
+
+        # report what has arrived already, block only on a full window
+        while self.pending and self.collect(timeout=0):
+            pass
+        while len(self.pending) >= self.window:
+            self.collect()
+
+    def collect(self, timeout=-1):
+        '''Wait for the oldest outstanding operation, returns False if it is
+           not finished within timeout seconds'''
+        msgid, dn, tag = self.pending[0]
+        error = None
+
+        try:
+            rtype, rdata = self.session.ldap_result(msgid, timeout)
+            if rtype is None:
+                return False
+        except ldap.LDAPError, e:
+            error = e
+            self.errors += 1
+
+        self.pending.popleft()
+        self.done += 1
+        if self.callback:
+            self.callback(dn, tag, error)
+
+        return True
+
+    def flush(self):
+        while self.pending:
+            self.collect()
+
+    def wait(self, dn):
+        '''Wait until no operation on dn is outstanding, e.g. before adding
+           an entry below it'''
+        key = dn.lower()
+        while [p for p in self.pending if p[1].lower() == key]:
+            self.collect()
+
+class ChangeSet(object):
+    '''Pending attribute changes of one entry, sent as a single modify'''
+    def __init__(self, ldapSession, dn):
+        self.session = ldapSession
+        self.dn      = dn
+        self.mods    = []
+
+    def __len__(self):
+        return len(self.mods)
+
+    def replace(self, attribute, values):
+        self.mods.append((ldap.MOD_REPLACE, attribute, values))
+
+    def add(self, attribute, values):
+        self.mods.append((ldap.MOD_ADD, attribute, values))
+
+    def delete(self, attribute, values=None):
+        self.mods.append((ldap.MOD_DELETE, attribute, values))
+
+    def attributes(self, mods=None):
+        return [attribute for op, attribute, values in (mods or self.mods)]
+
+    def isSamba(self, attribute):
+        return attribute.lower().startswith('samba')
+
+    def commit(self):
+        '''Send all changes in one modify. Returns the list of Samba
+           attributes which were left out because the entry is not a
+           sambaSamAccount, in that case a second modify applies the rest.'''
+        skipped = []
+
+        try:
+            self.session.ldap_modify(self.dn, self.mods)
+        except ldap.OBJECT_CLASS_VIOLATION, e:
+            mods    = [m for m in self.mods if not self.isSamba(m[1])]
+            skipped = [m for m in self.mods if self.isSamba(m[1])]
+            if not mods or not skipped:
+                raise
+            self.session.ldap_modify(self.dn, mods)
+
+        self.mods = []
+        return self.attributes(skipped)
+
+class LookupCache(object):
+    '''Read-through cache of name and ID lookups, bounded to size entries
+       with least recently used eviction. Entries expire after ttl seconds,
+       a ttl of 0 disables the cache. With a filename the entries are
+       loaded from and saved to that file, so that repeated runs share
+       them.'''
+    def __init__(self, size=1024, ttl=300, filename=None):
+        self.size     = size
+        self.ttl      = ttl
+        self.filename = filename
+        self.entries  = collections.OrderedDict()  # key -> (expires, value)
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+        if filename:
+            self.load()
+            atexit.register(self.save)
+
+    def get(self, key):
+        '''Return the cached value of key or None'''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # move to the end, the most recently used position
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if not self.ttl or value is None:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def discardKind(self, kind):
+        '''Drop all entries of one lookup kind, the first part of the key'''
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == kind]:
+                del self.entries[key]
+
+    def load(self):
+        try:
+            f = open(self.filename)
+            try:
+                entries = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            return
+
+        now = time.time()
+        for kind, name, expires, value in entries[-self.size:]:
+            if expires > now:
+                # python-ldap hands out UTF-8 encoded str, not unicode
+                if isinstance(value, list):
+                    value = [v.encode('utf-8') for v in value]
+                else:
+                    value = value.encode('utf-8')
+                key = (kind.encode('utf-8'), name.encode('utf-8'))
+                self.entries[key] = (expires, value)
+
+    def save(self):
+        with self.lock:
+            entries = [[k[0], k[1], e[0], e[1]]
+                       for k, e in self.entries.iteritems()]
+
+        # write a private temporary file and rename it over the old one
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            fd, name = tempfile.mkstemp(dir=directory)
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(entries, f)
+            finally:
+                f.close()
+            os.rename(name, self.filename)
+        except (IOError, OSError), e:
+            print >>sys.stderr, '%s: cache not saved: %s' % (self.filename, e)
+
+class IdBitmap(object):
+    '''Set of non negative integer IDs (uidNumber, gidNumber, RID) kept as
+       a sparse bitmap: a page of pageBits bits is allocated when the first
+       ID in its range is added, so a million IDs take about 128 kB'''
+    pageBits = 65536
+
+    def __init__(self):
+        self.pages = {}  # page number -> bytearray of pageBits / 8 bytes
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        page, bit = divmod(id, self.pageBits)
+        bits = self.pages.get(page)
+        return bits is not None and bool(bits[bit >> 3] & (1 << (bit & 7)))
+
+    def add(self, id):
+        '''Add id, returns False if it was present already'''
+        page, bit = divmod(id, self.pageBits)
+        bits = self.pages.get(page)
+        if bits is None:
+            bits = self.pages[page] = bytearray(self.pageBits >> 3)
+
+        mask = 1 << (bit & 7)
+        if bits[bit >> 3] & mask:
+            return False
+        bits[bit >> 3] |= mask
+        self.count += 1
+        return True
+
+    def __iter__(self):
+        '''Yield the IDs in ascending order'''
+        for page in sorted(self.pages):
+            bits = self.pages[page]
+            base = page * self.pageBits
+            for i, byte in enumerate(bits):
+                if byte:
+                    for bit in range(8):
+                        if byte & (1 << bit):
+                            yield base + i * 8 + bit
+
+    def max(self):
+        '''Return the highest ID, None if the set is empty'''
+        for page in sorted(self.pages, reverse=True):
+            bits = self.pages[page]
+            for i in range(len(bits) - 1, -1, -1):
+                if bits[i]:
+                    for bit in range(7, -1, -1):
+                        if bits[i] & (1 << bit):
+                            return page * self.pageBits + i * 8 + bit
+        return None
+
+    def lowestFree(self, start=0):
+        '''Return the lowest ID not in the set, at least start'''
+        id = start
+        while True:
+            page, bit = divmod(id, self.pageBits)
+            bits = self.pages.get(page)
+            if bits is None:
+                return id
+            byte = bits[bit >> 3]
+            if byte == 0xff:
+                # skip eight used IDs at once
+                id = (id | 7) + 1
+            elif byte & (1 << (bit & 7)):
+                id += 1
+            else:
+                return id
+
+    def nextUsed(self, start, stop):
+        '''Return the lowest ID in the set from start up to stop
+           (exclusive), None if there is none'''
+        id = start
+        while id < stop:
+            page, bit = divmod(id, self.pageBits)
+            bits = self.pages.get(page)
+            if bits is None:
+                id = (page + 1) * self.pageBits
+            elif bits[bit >> 3] == 0:
+                id = (id | 7) + 1
+            elif bits[bit >> 3] & (1 << (bit & 7)):
+                return id
+            else:
+                id += 1
+        return None
+
+    def freeRange(self, count, start=0):
+        '''Return the first of the lowest count consecutive IDs not in the
+           set, at least start'''
+        first = self.lowestFree(start)
+        while True:
+            used = self.nextUsed(first, first + count)
+            if used is None:
+                return first
+            first = self.lowestFree(used + 1)
+
+    def pack(self):
+        '''Return the pages as {page: base64 of the compressed bits}, for
+           JSON'''
+        return dict((str(page), base64.b64encode(zlib.compress(str(bits))))
+                    for page, bits in self.pages.iteritems())
+
+    @classmethod
+    def unpack(cls, pages):
+        ids = cls()
+        for page, data in pages.iteritems():
+            bits = bytearray(zlib.decompress(base64.b64decode(data)))
+            if len(bits) != cls.pageBits >> 3:
+                raise ValueError('page %s: %d bytes' % (page, len(bits)))
+            ids.pages[int(page)] = bits
+            ids.count += sum(bin(byte).count('1') for byte in bits if byte)
+        return ids
+
+class IdMap(object):
+    '''uidNumbers, gidNumbers and RIDs in use, for handing out the lowest
+       free IDs instead of advancing the counters of the sambaDomain entry
+       ([samba] id allocation = lowest).
+
+       The IDs are read with one paged scan of the [samba] ldap suffix. With
+       a filename they are saved, later the entries changed since are read
+       (modifyTimestamp) every interval seconds, until the map is older than
+       maxAge seconds and the suffix is scanned again. IDs of deleted entries
+       are only freed by such a scan, until then they are not reused.
+
+       Blocks reserved from a counter are handed out for at most lifetime
+       seconds, so only IDs below a counter value seen at least lifetime ago
+       are reused: nobody can hold them any more. The counter values seen
+       (marks) and the free ranges handed out (claims, valid for lifetime
+       seconds) are kept in the description values of one entry below the
+       sambaDomain entry, changed with a compare and swap of its serial
+       value. A free range is checked on the server before it is handed
+       out. One map may be shared by several sessions.'''
+    counters = ('uidNumber', 'gidNumber', 'sambaNextRid')
+    filter   = '(|(objectClass=posixAccount)(objectClass=posixGroup)' \
+               '(objectClass=sambaSamAccount)(objectClass=sambaGroupMapping))'
+
+    def __init__(self, filename=None, maxAge=86400, interval=60, lifetime=300):
+        self.filename  = filename
+        self.maxAge    = maxAge
+        self.interval  = interval
+        self.lifetime  = lifetime
+        self.lock      = threading.RLock()
+        self.ids       = None  # counter attribute -> IdBitmap
+        self.scanned   = 0     # time of the last full scan
+        self.refreshed = 0     # time of the last scan of any kind
+        self.stamp     = None  # highest modifyTimestamp seen
+        self.suffix    = None
+
+        if filename:
+            atexit.register(self.save)
+
+    def refresh(self, acc):
+        '''Bring the map up to date: load it, then read the changed entries
+           or scan everything'''
+        with self.lock:
+            suffix = acc.cfg.getOp('samba', 'ldap suffix')
+            if self.ids is None and self.filename:
+                self.load()
+            if self.ids is None or self.suffix != suffix or not self.stamp \
+               or self.scanned + self.maxAge < time.time():
+                self.ids     = dict((c, IdBitmap()) for c in self.counters)
+                self.scanned = time.time()
+                self.suffix  = suffix
+                self.scan(acc, self.filter)
+            else:
+                self.scan(acc, '(&%s(modifyTimestamp>=%s))' % (self.filter,
+                                                              self.stamp))
+            self.refreshed = time.time()
+            self.save()
+
+    def scan(self, acc, filter):
+        domainSID = acc.getDomainSID() + '-'
+        for dn, attrs in acc.ldap_search_iter(self.suffix, filter,
+                              ['objectClass', 'uidNumber', 'gidNumber',
+                               'sambaSID', 'modifyTimestamp']):
+            classes = [c.lower() for c in attrs.get('objectClass', [])]
+            if 'posixaccount' in classes:
+                self.add('uidNumber', attrs.get('uidNumber', []))
+            if 'posixgroup' in classes:
+                self.add('gidNumber', attrs.get('gidNumber', []))
+            self.add('sambaNextRid', [sid[len(domainSID):]
+                                      for sid in attrs.get('sambaSID', [])
+                                      if sid.startswith(domainSID)])
+            for stamp in attrs.get('modifyTimestamp', []):
+                # generalized time, the same length compares as text
+                if stamp > self.stamp:
+                    self.stamp = stamp
+
+    def add(self, counter, values):
+        for value in values:
+            if value.isdigit():
+                self.ids[counter].add(int(value))
+
+    def allocate(self, acc, counter, count, start, limit):
+        '''Return the first of the lowest count consecutive free IDs from
+           start up to the watermark below the counter value limit, claimed
+           and marked used. None if there is no such gap.'''
+        with self.lock:
+            if self.ids is None or \
+               self.refreshed + self.interval < time.time():
+                self.refresh(acc)
+            ids = self.ids[counter]
+
+            for attempt in range(acc.idRetries):
+                values  = self.readClaims(acc)
+                now     = int(time.time())
+                removed = []
+                added   = []
+                held    = []
+                marks   = []
+
+                for value in values:
+                    fields = value.split() or ['']
+                    try:
+                        if fields[0] == 'claim' and len(fields) == 5:
+                            first, n, stamp = [int(f) for f in fields[2:]]
+                            if stamp + self.lifetime < now:
+                                removed.append(value)
+                            elif fields[1] == counter:
+                                held.extend(range(first, first + n))
+                        elif fields[0] == 'mark' and len(fields) == 4 and \
+                             fields[1] == counter:
+                            marks.append((int(fields[3]), int(fields[2]), value))
+                    except ValueError, e:
+                        removed.append(value)
+
+                # one new mark per lifetime, unless one of the same or a
+                # higher value is there already
+                if not [m for m in marks if m[1] >= limit or
+                                            m[0] + self.lifetime > now]:
+                    value = 'mark %s %d %d' % (counter, limit, now)
+                    marks.append((now, limit, value))
+                    added.append(value)
+                old = [m for m in marks if m[0] + self.lifetime <= now]
+                watermark = None
+                if old:
+                    best      = max(old, key=lambda m: m[1])
+                    watermark = best[1]
+                    removed.extend([m[2] for m in old if m is not best])
+
+                first = None
+                if watermark is not None:
+                    first = self.freeRange(ids, held, count, start)
+                    if first + count > min(limit, watermark):
+                        first = None
+                    else:
+                        added.append('claim %s %d %d %d' % (counter, first,
+                                                            count, now))
+
+                if added or removed:
+                    if not self.changeClaims(acc, values, removed, added):
+                        # someone else changed them meanwhile
+                        time.sleep(random.uniform(0, 0.05 * attempt))
+                        continue
+                if first is None:
+                    return None
+
+                wanted = range(first, first + count)
+                taken  = self.taken(acc, counter, wanted)
+                for id in taken or wanted:
+                    ids.add(id)
+                if not taken:
+                    return first
+
+            return None
+
+    def freeRange(self, ids, held, count, start):
+        '''Lowest count free IDs from start, none of them held'''
+        first = start
+        while True:
+            first = ids.freeRange(count, first)
+            clash = [id for id in held if first <= id < first + count]
+            if not clash:
+                return first
+            first = max(clash) + 1
+
+    def use(self, counter, first, count=1):
+        '''Mark IDs handed out by the counter as used'''
+        with self.lock:
+            if self.ids is not None:
+                for id in range(first, first + count):
+                    self.ids[counter].add(id)
+
+    def claimDN(self, acc):
+        return 'cn=ldapsmb id claims,' + acc.domainDN()
+
+    def readClaims(self, acc):
+        '''Return the values of the claim entry, created if missing'''
+        dn = self.claimDN(acc)
+        try:
+            for entrydn, attrs in acc.ldap_search(dn, '(objectClass=*)',
+                                                  ['description'],
+                                                  ldap.SCOPE_BASE):
+                return attrs.get('description', [])
+        except ldap.NO_SUCH_OBJECT, e:
+            pass
+
+        try:
+            acc.ldap_add(dn, [('objectClass', ['organizationalRole']),
+                              ('cn', ['ldapsmb id claims']),
+                              ('description', ['serial 0'])])
+        except ldap.ALREADY_EXISTS, e:
+            return self.readClaims(acc)
+        return ['serial 0']
+
+    def changeClaims(self, acc, values, removed, added):
+        '''Replace the claim values read before, returns False if they
+           changed meanwhile'''
+        serials = [v for v in values if v.startswith('serial ')]
+        serial  = 0
+        if serials and serials[0][7:].isdigit():
+            serial = int(serials[0][7:])
+
+        # compare and swap: the serial is deleted, or added if missing
+        attrs = [(ldap.MOD_ADD, 'description',
+                  ['serial %d' % (serial + 1)] + added)]
+        if serials or removed:
+            attrs.insert(0, (ldap.MOD_DELETE, 'description', serials + removed))
+        try:
+            acc.ldap_modify(self.claimDN(acc), attrs)
+        except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS,
+                ldap.NO_SUCH_OBJECT), e:
+            return False
+        return True
+
+    def taken(self, acc, counter, ids):
+        '''Return the ids already used on the server'''
+        if counter == 'sambaNextRid':
+            prefix = acc.getDomainSID() + '-'
+            values = [prefix + str(id) for id in ids]
+            found  = acc.resolve(self.suffix, 'sambaSID', values, [])
+            return [int(sid[len(prefix):]) for sid in found]
+
+        objectClass = counter == 'uidNumber' and 'posixAccount' or 'posixGroup'
+        found = acc.resolve(self.suffix, counter, [str(id) for id in ids], [],
+                            objectClass)
+        return [int(id) for id in found]
+
+    def load(self):
+        try:
+            f = open(self.filename)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            ids     = dict((c, IdBitmap.unpack(data['ids'][c]))
+                           for c in self.counters)
+            scanned = float(data['scanned'])
+            stamp   = data['stamp'] and data['stamp'].encode('utf-8')
+            suffix  = data['suffix'].encode('utf-8')
+        except (IOError, ValueError, KeyError, TypeError, AttributeError,
+                zlib.error), e:
+            return
+
+        self.ids     = ids
+        self.scanned = scanned
+        self.stamp   = stamp
+        self.suffix  = suffix
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            if self.ids is None:
+                return
+            data = { 'suffix': self.suffix, 'scanned': self.scanned,
+                     'stamp': self.stamp,
+                     'ids': dict((c, self.ids[c].pack())
+                                 for c in self.counters) }
+
+        # write a private temporary file and rename it over the old one
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            fd, name = tempfile.mkstemp(dir=directory)
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+            os.rename(name, self.filename)
+        except (IOError, OSError), e:
+            print >>sys.stderr, '%s: ID map not saved: %s' % (self.filename, e)
 
 class Account(LDAP):
     '''Management of user account data in LDAP'''
-    def __init__(self, configFile):
+    # uid of prestaged machine accounts, followed by their uidNumber
+    prestagePrefix = 'prestaged-'
+    # values per OR filter and searches in flight of the resolve* lookups
+    resolveChunk   = 100
+    resolveWindow  = 8
+
+    def __init__(self, configFile, cache=None):
         self.cfg = Config(configFile)
         uri      = self.cfg.getOp('ldap', 'uri')
         binddn   = self.cfg.getOp('ldap', 'binddn')
         passwd   = self.cfg.getOp('ldap', 'passwd')
         usetls   = self.cfg.getboolean('ldap', 'usetls')
         
+        pageSize = self.cfg.getOp('ldap', 'page size')
+        if pageSize:
+            self.pageSize = int(pageSize)
+
         super(Account, self).__init__(uri, binddn, passwd, bool(usetls))
 
-    def getNextFreeUid(self):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
-        filter = 'sambaDomainName=' + domain
-        uid    = None
+        # sambaDomain entry, see getDomain
+        self.domain      = None
+        # locally reserved id ranges: counter attribute -> [next, end, time reserved]
+        self.idPools     = {}
+        self.idBlockSize = int(self.cfg.getOp('samba', 'id block size') or 1)
+        self.idRetries   = int(self.cfg.getOp('samba', 'id retries') or 10)
+        # seconds a reserved block is handed out from, see IdMap
+        self.idLifetime  = int(self.cfg.getOp('samba', 'id block lifetime')
+                               or 300)
+        # used IDs for reusing gaps, may be shared by several sessions
+        self.idMap       = None
+        if self.cfg.getOp('samba', 'id allocation') == 'lowest':
+            self.idMap = IdMap(self.cfg.getOp('samba', 'id map file'),
+                               int(self.cfg.getOp('samba', 'id map max age')
+                                   or 86400),
+                               int(self.cfg.getOp('samba', 'id map interval')
+                                   or 60),
+                               self.idLifetime)
+
+        # name and ID lookups, may be shared by several sessions
+        if cache is None:
+            cache = LookupCache(int(self.cfg.getOp('cache', 'size') or 1024),
+                                int(self.cfg.getOp('cache', 'ttl') or 300),
+                                self.cfg.getOp('cache', 'file'))
+        self.cache = cache
+
+        # operations which failed, see failed
+        self.failures = []
+
+    def failed(self, dn, error):
+        '''Note that the operation on dn failed with error (an LDAPError or
+           a message). The methods print and carry on after errors, callers
+           learn the outcome from failures. Errors handled as success, e.g.
+           adding a member twice, are not noted.'''
+        self.failures.append((dn, error))
+
+    # writes through the Account drop the cached lookups they affect
+    def ldap_add(self, dn, attrs):
+        self.invalidateDN(dn)
+        super(Account, self).ldap_add(dn, attrs)
 
-        result = self.ldap_search(suffix, filter, ['uidNumber'])
-        
-        if result:
-            uid = result[0][1]['uidNumber'][0]
-        else:
-            raise("can't find next free uid")
-            
-        return uid
+    def ldap_del(self, dn):
+        self.invalidateDN(dn)
+        super(Account, self).ldap_del(dn)
+
+    def ldap_modify(self, dn, attrs):
+        self.invalidateDN(dn)
+        super(Account, self).ldap_modify(dn, attrs)
+
+    def ldap_rename(self, dn, newrdn):
+        self.invalidateDN(dn)
+        super(Account, self).ldap_rename(dn, newrdn)
+
+    def ldap_add_async(self, dn, attrs):
+        self.invalidateDN(dn)
+        return super(Account, self).ldap_add_async(dn, attrs)
+
+    def ldap_modify_async(self, dn, attrs):
+        self.invalidateDN(dn)
+        return super(Account, self).ldap_modify_async(dn, attrs)
+
+    def ldap_del_async(self, dn):
+        self.invalidateDN(dn)
+        return super(Account, self).ldap_del_async(dn)
+
+    def invalidateDN(self, dn):
+        '''Drop cached lookups which a change of the entry dn may affect'''
+        if ',' not in dn:
+            return
+        rdn, base = dn.split(',', 1)
+        name = rdn.split('=', 1)[-1]
+
+        if base.lower() == self.userBase().lower():
+            self.cache.discard(('uidNumber', name), ('gidNumber', name))
+        elif base.lower() == self.groupBase().lower():
+            self.cache.discard(('members', name))
+            self.cache.discardKind('cn')
+
+    def userBase(self):
+        suffix      = self.cfg.getOp('samba', 'ldap suffix')
+        user_suffix = self.cfg.getOp('samba', 'ldap user suffix')
 
-    def setNextFreeUid(self, uid):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
+        return '%s,%s' % (user_suffix, suffix)
 
-        dn = 'sambaDomainName=%s,%s' % (domain, suffix)
-        self.ldap_update_attribute(dn, 'uidNumber', uid)
+    def groupBase(self):
+        suffix       = self.cfg.getOp('samba', 'ldap suffix')
+        group_suffix = self.cfg.getOp('samba', 'ldap group suffix')
 
-    def getNextFreeGid(self):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
-        filter = 'sambaDomainName=' + domain
-        gid    = None
+        return '%s,%s' % (group_suffix, suffix)
 
-        result = self.ldap_search(suffix, filter, ['gidNumber'])
+    def machineBase(self):
+        suffix         = self.cfg.getOp('samba', 'ldap suffix')
+        machine_suffix = self.cfg.getOp('samba', 'ldap machine suffix')
 
-        if result:
-            gid = result[0][1]['gidNumber'][0]
+        return '%s,%s' % (machine_suffix, suffix)
 
-        return gid
+    def userDN(self, name):
+        return 'uid=%s,%s' % (name, self.userBase())
 
-    def setNextFreeGid(self, gid):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
+    def groupDN(self, name):
+        return 'cn=%s,%s' % (name, self.groupBase())
 
-        dn = 'sambaDomainName=%s,%s' % (domain, suffix)
-        self.ldap_update_attribute(dn, 'gidNumber', str(gid))
+    def machineDN(self, name):
+        # appending '$' to the end of the name, marks it as a machine
+        if not name.endswith('$'):
+            name = name + '$'
 
-    def getNextFreeRid(self):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
-        filter = 'sambaDomainName=' + domain
-        rid    = None
+        return 'uid=%s,%s' % (name, self.machineBase())
 
-        result = self.ldap_search(suffix, filter, ['sambaNextRid'])
+    def userChanges(self, name):
+        return ChangeSet(self, self.userDN(name))
 
-        if result:
-            rid = result[0][1]['sambaNextRid'][0]
+    def groupChanges(self, name):
+        return ChangeSet(self, self.groupDN(name))
 
-        return rid
+    def machineChanges(self, name):
+        return ChangeSet(self, self.machineDN(name))
 
-    def setNextFreeRid(self, rid):
+    def applyChanges(self, changes):
+        '''Send a ChangeSet as one modify and report the outcome'''
+        if not changes:
+            return
+
+        dn      = changes.dn
+        changed = changes.attributes()
+
+        try:
+            skipped = changes.commit()
+            changed = [a for a in changed if a not in skipped]
+            print '%s: Successfully changed %s' % (dn, ', '.join(changed))
+            if skipped:
+                print '%s: Not a samba account - %s not changed' % (dn, ', '.join(skipped))
+        except ldap.NO_SUCH_OBJECT, e:
+            print dn + ': does not exist!'
+            self.failed(dn, e)
+        except ldap.UNDEFINED_TYPE, e:
+            print dn + ': ' + e[0]['info'] + '. Is samba3 schema installed?'
+            self.failed(dn, e)
+        except ldap.LDAPError, e:
+            print dn + ': ', e.args
+            self.failed(dn, e)
+
+    def listEntries(self, basedn, filter, attributes, outputFormat='json',
+                    out=None):
+        '''Write matching entries to out (stdout) one per line as they are
+           received, either as JSON objects or as tab separated values with
+           a header line. Multiple values are joined with a comma in TSV.'''
+        out = out or sys.stdout
+
+        if outputFormat == 'tsv':
+            out.write('dn\t' + '\t'.join(attributes) + '\n')
+
+        try:
+            for dn, attrs in self.ldap_search_iter(basedn, filter, attributes):
+                if outputFormat == 'tsv':
+                    values = dict((a.lower(), v) for a, v in attrs.iteritems())
+                    row    = [dn] + [','.join(values.get(a.lower(), []))
+                                     for a in attributes]
+                    out.write('\t'.join([self.tsvEscape(v) for v in row]) + '\n')
+                else:
+                    out.write(json.dumps(self.jsonEntry(dn, attrs)) + '\n')
+        except IOError, e:
+            # output closed early, e.g. piped into head
+            if e.errno != errno.EPIPE:
+                raise
+
+    def tsvEscape(self, value):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    def jsonEntry(self, dn, attrs):
+        '''Entry as dict for JSON output, values which are no UTF-8 text
+           are given base64 encoded as attribute;base64'''
+        entry = {'dn': dn}
+
+        for attribute, values in attrs.iteritems():
+            try:
+                entry[attribute] = [v.decode('utf-8') for v in values]
+            except UnicodeDecodeError, e:
+                entry[attribute + ';base64'] = [base64.b64encode(v) for v in values]
+
+        return entry
+
+    def domainDN(self):
         suffix = self.cfg.getOp('samba', 'ldap suffix')
         domain = self.cfg.getOp('samba', 'sambaDomain')
 
-        dn = 'sambaDomainName=%s,%s' % (domain, suffix)
-        self.ldap_update_attribute(dn, 'sambaNextRid', rid)
+        return 'sambaDomainName=%s,%s' % (domain, suffix)
+
+    def getDomain(self, attributes=None, refresh=False):
+        '''Return the attributes of the sambaDomain entry, all or the listed
+           ones. The entry is read once with a base scope search and cached
+           for the process, pass refresh to read it again.'''
+        if self.domain is None or refresh:
+            self.domain = self.readDomain()
+
+        if attributes is None:
+            return self.domain
+        return dict((a, self.domain[a]) for a in attributes if a in self.domain)
+
+    def readDomain(self):
+        dn     = self.domainDN()
+        result = self.ldap_search(dn, '(objectClass=*)', None, ldap.SCOPE_BASE)
+        if not result:
+            raise IdAllocationError('%s: not found' % dn)
+        return result[0][1]
+
+    def reserveIds(self, attribute, count=1):
+        '''Atomically reserve count consecutive values of the counter
+           attribute (uidNumber, gidNumber, sambaNextRid) on the sambaDomain
+           entry and return the first one'''
+        dn     = self.domainDN()
+        domain = self.getDomain()
+
+        for attempt in range(self.idRetries):
+            if attribute not in domain:
+                raise IdAllocationError('%s: no %s found' % (dn, attribute))
+            current = domain[attribute][0]
+            new     = str(int(current) + count)
+
+            # compare and swap: the delete fails if someone else was faster
+            attrs = [(ldap.MOD_DELETE, attribute, [current]),
+                     (ldap.MOD_ADD, attribute, [new])]
+            try:
+                self.ldap_modify(dn, attrs)
+                domain[attribute] = [new]
+                return int(current)
+            except ldap.NO_SUCH_ATTRIBUTE, e:
+                # the cached value is stale, back off and read it again
+                time.sleep(random.uniform(0, 0.05 * attempt))
+                domain = self.getDomain(refresh=True)
+
+        raise IdAllocationError('%s: could not reserve %s after %d attempts'
+                                % (dn, attribute, self.idRetries))
+
+    def allocateIds(self, attribute, count=1):
+        '''Return the first of count consecutive unused IDs of a counter
+           attribute. With an IdMap the lowest free range between the first
+           ID of the domain ([samba] uid, gid and rid) and the counter is
+           reused, otherwise the counter is advanced.'''
+        if self.idMap is not None:
+            start = self.cfg.getOp('samba', {'uidNumber': 'uid',
+                                             'gidNumber': 'gid',
+                                             'sambaNextRid': 'rid'}[attribute])
+            limit = self.getDomain([attribute]).get(attribute)
+            if limit:
+                first = self.idMap.allocate(self, attribute, count,
+                                            int(start or 1000), int(limit[0]))
+                if first is not None:
+                    return first
+
+        first = self.reserveIds(attribute, count)
+        if self.idMap is not None:
+            self.idMap.use(attribute, first, count)
+        return first
+
+    def allocateId(self, attribute):
+        '''Hand out the next ID of a counter attribute, reserving a block
+           of idBlockSize IDs on the server when the local range is used up
+           or older than idLifetime seconds. IDs reserved but never handed
+           out are left unused.'''
+        pool = self.idPools.get(attribute)
+        if not pool or pool[0] >= pool[1] or \
+           pool[2] + self.idLifetime < time.time():
+            first = self.allocateIds(attribute, self.idBlockSize)
+            pool  = self.idPools[attribute] = [first, first + self.idBlockSize,
+                                               time.time()]
+
+        id = pool[0]
+        pool[0] += 1
+        return str(id)
+
+    def releaseIds(self, allocated):
+        '''Give back IDs from allocateId, [(attribute, id), ...], whose entry
+           was not created. The last ID handed out goes back to the local
+           range. If it was the last one reserved and nobody reserved IDs
+           since, the counter is put back as well.'''
+        for attribute, id in allocated:
+            pool = self.idPools.get(attribute)
+            if not pool or pool[0] != int(id) + 1:
+                continue
+            pool[0] -= 1
+            if pool[1] != pool[0] + 1 or \
+               self.getDomain().get(attribute) != [str(pool[1])]:
+                continue
+
+            # compare and swap, fails if the counter moved on meanwhile
+            attrs = [(ldap.MOD_DELETE, attribute, [str(pool[1])]),
+                     (ldap.MOD_ADD, attribute, [str(pool[0])])]
+            try:
+                self.ldap_modify(self.domainDN(), attrs)
+                self.getDomain()[attribute] = [str(pool[0])]
+                pool[1] = pool[0]
+            except ldap.LDAPError, e:
+                pass
 
-    def getUserUid(self, username):
-        suffix      = self.cfg.getOp('samba', 'ldap suffix')
-        user_suffix = self.cfg.getOp('samba', 'ldap user suffix')
-        search_dn   = '%s,%s' % (user_suffix, suffix)
-        filter      = 'uid=%s' % (username)
-        uid         = None
+    def getNextFreeUid(self):
+        uid = self.getDomain(['uidNumber'], refresh=True).get('uidNumber')
 
-        result = self.ldap_search(search_dn, filter, ['uidNumber'])
+        if not uid:
+            raise IdAllocationError("can't find next free uid")
 
-        if result:
-            uid = result[0][1]['uidNumber'][0]
+        return uid[0]
 
-        return uid
+    def setNextFreeUid(self, uid):
+        self.ldap_update_attribute(self.domainDN(), 'uidNumber', uid)
+        self.domain = None
 
-    def getUserGid(self, username):
-        suffix      = self.cfg.getOp('samba', 'ldap suffix')
-        user_suffix = self.cfg.getOp('samba', 'ldap user suffix')
-        search_dn   = '%s,%s' % (user_suffix, suffix)
-        filter      = 'uid=%s' % (username)
-        gid         = None
+    def getNextFreeGid(self):
+        gid = self.getDomain(['gidNumber'], refresh=True).get('gidNumber')
+
+        if gid:
+            return gid[0]
+
+    def setNextFreeGid(self, gid):
+        self.ldap_update_attribute(self.domainDN(), 'gidNumber', str(gid))
+        self.domain = None
+
+    def getNextFreeRid(self):
+        rid = self.getDomain(['sambaNextRid'], refresh=True).get('sambaNextRid')
+
+        if rid:
+            return rid[0]
+
+    def setNextFreeRid(self, rid):
+        self.ldap_update_attribute(self.domainDN(), 'sambaNextRid', rid)
+        self.domain = None
+
+    def orFilters(self, attribute, values, objectClass=None, chunk=None):
+        '''Yield filters matching attribute against at most chunk of the
+           values each: (|(uid=a)(uid=b)...)'''
+        values = list(values)
+        chunk  = chunk or self.resolveChunk
+
+        for i in range(0, len(values), chunk):
+            filter = '(|%s)' % ''.join(['(%s=%s)' % (attribute,
+                                        ldap.filter.escape_filter_chars(v))
+                                        for v in values[i:i + chunk]])
+            if objectClass:
+                filter = '(&(objectClass=%s)%s)' % (objectClass, filter)
+            yield filter
+
+    def resolve(self, basedn, attribute, values, attributes, objectClass=None,
+                chunk=None):
+        '''Look up many values of attribute with chunked OR filters,
+           searched concurrently. Returns {value: (dn, attributes)} for the
+           values found, values compare as strings, case insensitive.'''
+        wanted = {}
+        for v in values:
+            wanted.setdefault(str(v).lower(), []).append(v)
+        found   = {}
+        filters = self.orFilters(attribute, [str(v[0]) for v in wanted.values()],
+                                 objectClass, chunk)
+
+        for dn, attrs in self.ldap_search_many(basedn, filters,
+                                               [attribute] + list(attributes),
+                                               window=self.resolveWindow):
+            for key, value in attrs.iteritems():
+                if key.lower() != attribute.lower():
+                    continue
+                for v in value:
+                    for name in wanted.get(v.lower(), []):
+                        found[name] = (dn, attrs)
+
+        return found
+
+    def resolveUsers(self, names, attributes=('uidNumber', 'gidNumber'),
+                     chunk=None):
+        '''Return {name: attributes} of many users, names not found are left
+           out. uidNumber and gidNumber are cached, e.g. to warm up idmap
+           lookups.'''
+        users = {}
+        for name, (dn, attrs) in self.resolve(self.userBase(), 'uid', names,
+                                              attributes, 'posixAccount',
+                                              chunk).iteritems():
+            users[name] = attrs
+            for attribute in ('uidNumber', 'gidNumber'):
+                if attribute in attrs:
+                    self.cache.set((attribute, name), attrs[attribute][0])
+        return users
+
+    def resolveGids(self, gids, chunk=None):
+        '''Return {gidNumber: group name} of many groups, like getGidName.
+           The gids may be numbers or strings.'''
+        groups = {}
+        for gid, (dn, attrs) in self.resolve(self.groupBase(), 'gidNumber',
+                                             gids, ['cn'], 'posixGroup',
+                                             chunk).iteritems():
+            groups[gid] = attrs['cn'][0]
+            self.cache.set(('cn', str(gid)), groups[gid])
+        return groups
+
+    def resolveSIDs(self, sids, chunk=None):
+        '''Return {sambaSID: dn} of the users, groups and machines of many
+           SIDs'''
+        suffix = self.cfg.getOp('samba', 'ldap suffix')
+        found  = self.resolve(suffix, 'sambaSID', sids, [], chunk=chunk)
+        return dict((sid, dn) for sid, (dn, attrs) in found.iteritems())
 
-        result = self.ldap_search(search_dn, filter, ['gidNumber'])
+    def getUser(self, name, attributes=None):
+        '''Return the listed attributes (all if None) of a user, read by dn
+           with one base scope search. None if there is no such user.'''
+        try:
+            result = self.ldap_search(self.userDN(name), '(objectClass=*)',
+                                      attributes, ldap.SCOPE_BASE)
+        except ldap.NO_SUCH_OBJECT, e:
+            return None
 
         if result:
-            gid = result[0][1]['gidNumber'][0]
+            return result[0][1]
+
+    def getUserIds(self, username):
+        '''Return uidNumber and gidNumber of a user, None for unknown ones'''
+        uid = self.cache.get(('uidNumber', username))
+        gid = self.cache.get(('gidNumber', username))
+
+        if uid is None or gid is None:
+            user = self.getUser(username, ['uidNumber', 'gidNumber']) or {}
+            uid  = user.get('uidNumber', [None])[0]
+            gid  = user.get('gidNumber', [None])[0]
+            self.cache.set(('uidNumber', username), uid)
+            self.cache.set(('gidNumber', username), gid)
+
+        return uid, gid
 
-        return gid
+    def getUserUid(self, username):
+        return self.getUserIds(username)[0]
+
+    def getUserGid(self, username):
+        return self.getUserIds(username)[1]
     
     def getGidName(self, gid):
-        suffix      = self.cfg.getOp('samba', 'ldap suffix')
-        group_suffix = self.cfg.getOp('samba', 'ldap group suffix')
-        search_dn   = '%s,%s' % (group_suffix, suffix)
-        filter      = 'gidNumber=%s' % (gid)
-        groupName   = None
-
-        result = self.ldap_search(search_dn, filter, ['cn'])
+        groupName = self.cache.get(('cn', gid))
 
-        if result:
-            groupName = result[0][1]['cn'][0]
+        if groupName is None:
+            filter = 'gidNumber=%s' % (gid)
+            result = self.ldap_search(self.groupBase(), filter, ['cn'])
+            if result:
+                groupName = result[0][1]['cn'][0]
+                self.cache.set(('cn', gid), groupName)
 
         return groupName
 
-    def getDomainSID(self):
-        suffix = self.cfg.getOp('samba', 'ldap suffix')
-        domain = self.cfg.getOp('samba', 'sambaDomain')
-        filter = 'sambaDomainName=' + domain
-        sid    = None
+    def getGroupMembers(self, groupname):
+        '''Return the memberUid values of a group, None if there is no
+           such group'''
+        members = self.cache.get(('members', groupname))
 
-        result = self.ldap_search(suffix, filter, ['sambaSID'])
+        if members is None:
+            try:
+                result = self.ldap_search(self.groupDN(groupname),
+                                          '(objectClass=*)', ['memberUid'],
+                                          ldap.SCOPE_BASE)
+            except ldap.NO_SUCH_OBJECT, e:
+                result = None
+            if result:
+                members = result[0][1].get('memberUid', [])
+                self.cache.set(('members', groupname), members)
 
-        if result:
-            sid = result[0][1]['sambaSID'][0]
+        return members
+
+    def getDomainSID(self):
+        sid = self.getDomain(['sambaSID']).get('sambaSID')
 
-        return sid
+        if sid:
+            return sid[0]
 
     def createSambaDomain(self, suffix=None, domainName=None, sambaSID=None,
                           nextFreeUid=None, nextFreeGid=None, nextFreeRid=None,
@@ -283,12 +1505,16 @@ class Account(LDAP):
             print dn + ': Successfully created'
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.INVALID_DN_SYNTAX, e:
             print dn + ': Invalid DN syntax. Is samba3 schema installed?'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ':', e.args
+            self.failed(dn, e)
 
     def createSambaGroup(self, name, gid, sambaSID=None, description=None,
                          sambaGroupType=None):
@@ -296,8 +1522,10 @@ class Account(LDAP):
         group_suffix = self.cfg.getOp('samba', 'ldap group suffix')
         objClasses   = ['top', 'namedObject', 'posixGroup', 'sambaGroupMapping']
 
+        allocated = []
         if not gid:
-            gid = self.getNextFreeGid()
+            gid = self.allocateId('gidNumber')
+            allocated.append(('gidNumber', gid))
         if not sambaSID:
             sambaSID = self.getDomainSID()
             sambaSID = sambaSID + '-' + gid
@@ -323,24 +1551,32 @@ class Account(LDAP):
         try:
             self.ldap_add(dn, attrs)
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.INVALID_SYNTAX, e:
             print dn + ': Invalid attribute syntax. Is samba3 schema installed?'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ': ', e.args
-        else:
-            self.setNextFreeGid(int(gid) + 1)
+            self.failed(dn, e)
+
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
 
     def createPosixGroup(self, name, gid, description=None):
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
         group_suffix = self.cfg.getOp('samba', 'ldap group suffix')
         objClasses   = ['top', 'posixGroup']
 
+        allocated = []
         if not gid:
-            gid = self.getNextFreeGid()
+            gid = self.allocateId('gidNumber')
+            allocated.append(('gidNumber', gid))
 
         if not description:
             description = ' '
@@ -357,16 +1593,22 @@ class Account(LDAP):
         try:
             self.ldap_add(dn, attrs)
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.INVALID_SYNTAX, e:
             print dn + ': Invalid attribute syntax'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ': ', e.args
-        else:
-            self.setNextFreeGid(int(gid) + 1)
+            self.failed(dn, e)
+
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
 
     def deleteGroup(self, name):
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
@@ -379,44 +1621,38 @@ class Account(LDAP):
             print dn + ': Successfully deleted'
         except ldap.LDAPError, e:
             print dn + ': ', e.args
+            self.failed(dn, e)
 
     def modifyGroup(self, name, attribute, value):
-        suffix       = self.cfg.getOp('samba', 'ldap suffix')
-        group_suffix = self.cfg.getOp('samba', 'ldap group suffix')
-
-        dn = 'cn=%s,%s,%s' % ( name, group_suffix, suffix )
-
-        try:
-            self.ldap_update_attribute(dn, attribute, [value])
-            print '%s: Successfully changed %s' % (dn, attribute)
-        except ldap.LDAPError, e:
-            print dn + ': ', e.args
+        changes = self.groupChanges(name)
+        changes.replace(attribute, [value])
+        self.applyChanges(changes)
 
     def createAixUser(self, name, uid=None, gid=None, home=None,
                       loginShell=None):
         #TODO: create AIX account entry
         pass
 
-    def createPosixUser(self, name, **kwargs):
+    def userAttrs(self, name, uid, gid=None, sambaSID=None, **kwargs):
+        '''Build the dn and attributes of a new Posix or (with sambaSID)
+           Samba user'''
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
         user_suffix  = self.cfg.getOp('samba', 'ldap user suffix')
         objClasses   = ['top', 'person', 'organizationalPerson',
                          'inetOrgPerson', 'posixAccount', 'shadowAccount']
 
         # set defaults
-        uid                 = kwargs.pop('uid', None)
-        if not uid:
-            uid = self.getNextFreeUid()
-            self.setNextFreeUid(str(int(uid)+1))
-        gid                 = kwargs.pop('uid', self.cfg.getOp('posix', 'defaultGidNumber'))
-        defHomePath = self.cfg.getOp('posix', 'homeDirPath')
-        home                = kwargs.pop('home', defHomePath + "/" + name)
+        if not gid:
+            gid = self.cfg.getOp('posix', 'defaultGidNumber')
+        home                = kwargs.pop('home', None)
+        if not home:
+            home = self.cfg.getOp('posix', 'homeDirPath') + "/" + name
         loginShell          = kwargs.pop('loginShell', None)
         if not loginShell:
             loginShell = self.cfg.getOp('posix', 'defaultShell')
-        givenName           = kwargs.pop('givenName', name)
-        sn                  = kwargs.pop('sn', name)
-        
+        givenName           = kwargs.pop('givenName', None) or name
+        sn                  = kwargs.pop('sn', None) or name
+
         dn = 'uid=%s,%s,%s' % (name, user_suffix, suffix)
 
         attrs = {
@@ -432,22 +1668,47 @@ class Account(LDAP):
                 'homeDirectory': home,
                 'loginShell': loginShell,
                 }
-        
+
+        if sambaSID:
+            attrs['objectClass'] = objClasses + ['sambaSamAccount']
+            attrs['sambaSID'] = sambaSID
+            attrs['sambaAcctFlags'] = kwargs.pop('sambaAcctFlags', None) or '[U          ]'
+
         #append remaing values, filter None values
         for key,value in kwargs.iteritems():
             if not value == None:
                 attrs[key] = value
+
+        return dn, attrs
+
+    def createPosixUser(self, name, **kwargs):
+        allocated = []
+        uid = kwargs.pop('uid', None)
+        if not uid:
+            uid = self.allocateId('uidNumber')
+            allocated.append(('uidNumber', uid))
+        gid = kwargs.pop('gid', None)
+
+        dn, attrs = self.userAttrs(name, uid, gid, **kwargs)
+        gid = attrs['gidNumber']
+
         addAttrs = ldap.modlist.addModlist(attrs)
         try:
             self.ldap_add(dn, addAttrs)
-            self.setNextFreeUid(str(int(uid) + 1))
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ':', e.args
+            self.failed(dn, e)
+
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
 
         #finally add user to it's primaryGroup
         group = self.getGidName(gid)
@@ -455,66 +1716,41 @@ class Account(LDAP):
             self.addUserToGroup(name, group)
 
     def createSambaUser(self, name, **kwargs):
-        suffix       = self.cfg.getOp('samba', 'ldap suffix')
-        user_suffix  = self.cfg.getOp('samba', 'ldap user suffix')
-        objClasses   = ['top', 'person', 'organizationalPerson', 'inetOrgPerson',
-                         'sambaSamAccount', 'posixAccount', 'shadowAccount']
-
-        # set defaults
-        uid                 = kwargs.pop('uid', None)
+        allocated = []
+        uid = kwargs.pop('uid', None)
         if not uid:
-            uid = self.getNextFreeUid()
-        gid                 = kwargs.pop('uid', self.cfg.getOp('posix', 'defaultGidNumber'))
-        defHomePath = self.cfg.getOp('posix', 'homeDirPath')
-        home                = kwargs.pop('home', defHomePath + "/" + name)
-        loginShell          = kwargs.pop('loginShell', None)
-        if not loginShell:
-            loginShell = self.cfg.getOp('posix', 'defaultShell')
-        givenName           = kwargs.pop('givenName', name)
-        sn                  = kwargs.pop('sn', name)
-        sambaSID            = kwargs.pop('sambaSID', None)
+            uid = self.allocateId('uidNumber')
+            allocated.append(('uidNumber', uid))
+        gid = kwargs.pop('gid', None)
+        sambaSID = kwargs.pop('sambaSID', None)
         if not sambaSID:
-            rid = self.getNextFreeRid()
+            rid = self.allocateId('sambaNextRid')
+            allocated.append(('sambaNextRid', rid))
             sambaSID = self.getDomainSID() + '-' + rid
-        sambaAcctFlags   = kwargs.pop('sambaAcctFlags', '[U          ]')
-        
-        dn = 'uid=%s,%s,%s' % (name, user_suffix, suffix)
 
-        attrs = {
-                'objectClass': objClasses,
-                'cn': givenName + " " + sn,
-                'givenName': givenName,
-                'sn': sn,
-                'uid': name,
-                'uidNumber': uid,
-                'gidNumber': gid,
-                'displayName': givenName + " " + sn,
-                'gecos': givenName + " " + sn,
-                'homeDirectory': home,
-                'loginShell': loginShell,
-                'sambaSID': sambaSID,
-                'sambaAcctFlags': sambaAcctFlags
-                }
-                
-        #append remaing values, filter None values
-        for key,value in kwargs.iteritems():
-            if not value == None:
-                attrs[key] = value
+        dn, attrs = self.userAttrs(name, uid, gid, sambaSID, **kwargs)
+        gid = attrs['gidNumber']
 
         addAttrs = ldap.modlist.addModlist(attrs)
         try:
             self.ldap_add(dn, addAttrs)
-            self.setNextFreeUid(str(int(uid)+1))
-            self.setNextFreeRid(str(int(rid)+1))
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.INVALID_SYNTAX, e:
             print dn + ': Invalid attribute syntax. Is samba3 schema installed?'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ':', e.args
+            self.failed(dn, e)
+
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
             
         #finally add user to it's primaryGroup
         group = self.getGidName(gid)
@@ -522,16 +1758,9 @@ class Account(LDAP):
             self.addUserToGroup(name, group)
 
     def modifyUser(self, name, attribute, value):
-        suffix       = self.cfg.getOp('samba', 'ldap suffix')
-        user_suffix  = self.cfg.getOp('samba', 'ldap user suffix')
-
-        dn = 'uid=%s,%s,%s' % (name, user_suffix, suffix)
-
-        try:
-            self.ldap_update_attribute(dn, attribute, [value])
-            print '%s: Successfully changed %s' % (dn, attribute)
-        except ldap.LDAPError, e:
-            print dn + ': ', e.args
+        changes = self.userChanges(name)
+        changes.replace(attribute, [value])
+        self.applyChanges(changes)
 
     def deleteUser(self, name):
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
@@ -558,8 +1787,68 @@ class Account(LDAP):
             print user_dn + ': Successfully deleted'
         except ldap.NO_SUCH_OBJECT, e:
             print user_dn + ': No such object!'
+            self.failed(user_dn, e)
         except ldap.LDAPError, e:
             print e
+            self.failed(user_dn, e)
+
+    def deleteUsers(self, names, window=64):
+        '''Delete many users at once. The group subtree is searched once,
+           every group then loses all its leaving members in one modify
+           before the users are deleted. Returns the number of failed
+           deletes and group updates.'''
+        leaving = collections.OrderedDict((name.lower(), name) for name in names)
+        groups  = collections.OrderedDict()  # group dn -> memberUids to remove
+        failed  = 0                          # group updates
+
+        # inverted memberUid index, restricted to the leaving users
+        for dn, attrs in self.ldap_search_iter(self.groupBase(), '(memberUid=*)',
+                                               ['memberUid']):
+            for member in attrs.get('memberUid', []):
+                if member.lower() in leaving:
+                    groups.setdefault(dn, []).append(member)
+
+        for dn, members in groups.iteritems():
+            try:
+                self.ldap_del_attribute(dn, 'memberUid', members)
+                print '%s: Successfully removed %d members' % (dn, len(members))
+            except ldap.NO_SUCH_ATTRIBUTE, e:
+                # the group changed since the scan, fall back to one at a time
+                for member in members:
+                    try:
+                        self.ldap_del_attribute(dn, 'memberUid', [member])
+                        print '%s: Successfully removed member %s' % (dn, member)
+                    except ldap.NO_SUCH_ATTRIBUTE, e:
+                        pass
+                    except ldap.LDAPError, e:
+                        print '%s: member %s:' % (dn, member), e.args
+                        self.failed(dn, e)
+                        failed += 1
+            except ldap.LDAPError, e:
+                print dn + ': ', e.args
+                self.failed(dn, e)
+                failed += 1
+
+        def deleted(dn, tag, error):
+            if error is None:
+                print dn + ': Successfully deleted'
+            elif isinstance(error, ldap.NO_SUCH_OBJECT):
+                print dn + ': No such object!'
+                self.failed(dn, error)
+            else:
+                print dn + ':', error.args
+                self.failed(dn, error)
+
+        pipeline = self.ldap_pipeline(window, deleted)
+        for name in leaving.itervalues():
+            pipeline.delete(self.userDN(name))
+        pipeline.flush()
+
+        print '%d users deleted, %d failed' % (pipeline.done - pipeline.errors,
+                                               pipeline.errors)
+        if failed:
+            print '%d group updates failed' % failed
+        return pipeline.errors + failed
 
     def createPosixMachine(self, name, uid=None, gid=None, displayName=None,
                            gecos=None, loginShell='/bin/false', home='/dev/null'):
@@ -573,9 +1862,10 @@ class Account(LDAP):
         if not m:
             name = name + '$'
 
+        allocated = []
         if not uid:
-            uid = self.getNextFreeUid()
-            self.setNextFreeUid(str(int(uid) + 1))
+            uid = self.allocateId('uidNumber')
+            allocated.append(('uidNumber', uid))
         if not gid:
             gid = '515' # 'Domain Computers'
         if not displayName:
@@ -601,25 +1891,31 @@ class Account(LDAP):
         try:
             self.ldap_add(dn, attrs)
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ':', e.args
+            self.failed(dn, e)
 
             samba.createSambaMachine(options.name, options.uidNumber,
                                      options.gidNumber, options.displayName,
                                      options.sambaSID)
 
-    def createSambaMachine(self, name, uid=None, gid=None, displayName=None,
-                           sambaSID=None, sambaPrimaryGroupSID=None,
-                           gecos=None, loginShell='/bin/false', home='/dev/null',
-                           sambaAcctFlags=None):
-        suffix         = self.cfg.getOp('samba', 'ldap suffix')
-        machine_suffix = self.cfg.getOp('samba', 'ldap machine suffix')
-        objClasses     = ['top', 'person', 'organizationalPerson',
-                           'inetOrgPerson', 'posixAccount', 'sambaSamAccount']
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
+
+    def sambaMachineAttrs(self, name, uid, gid=None, displayName=None,
+                          sambaSID=None, sambaPrimaryGroupSID=None,
+                          gecos=None, loginShell='/bin/false', home='/dev/null',
+                          sambaAcctFlags=None):
+        '''Build the dn and attributes of a new Samba machine'''
+        objClasses = ['top', 'person', 'organizationalPerson',
+                      'inetOrgPerson', 'posixAccount', 'sambaSamAccount']
 
         # append '$' to the end of the name, marking it as a machine
         m = re.match('.*\$$', name)
@@ -627,14 +1923,14 @@ class Account(LDAP):
             name = name + '$'
 
         # set defaults
-        if not uid:
-            uid = self.getNextFreeUid()
         if not gid:
             gid = '515' # 'Domain Computers'
+        if not sambaSID or not sambaPrimaryGroupSID:
+            domainSID = self.getDomainSID()
         if not sambaSID:
-            sambaSID = self.getDomainSID() + '-' + uid
+            sambaSID = domainSID + '-' + uid
         if not sambaPrimaryGroupSID:
-            sambaPrimaryGroupSID = self.getDomainSID() + '-' + gid
+            sambaPrimaryGroupSID = domainSID + '-' + gid
         if not displayName:
             displayName = name.upper()
         if not gecos:
@@ -642,13 +1938,11 @@ class Account(LDAP):
         if not sambaAcctFlags:
             sambaAcctFlags = '[W          ]'
 
-        dn = 'uid=%s,%s,%s' % (name, machine_suffix, suffix)
-
         attrs = [
             ("objectClass", objClasses ),
             ('cn', [name]),
             ('sn', [name]),
-            ('uid', [uid]),
+            ('uid', [name]),
             ('displayName', [displayName]),
             ('gecos', [gecos]),
             ('uidNumber', [uid]),
@@ -660,35 +1954,142 @@ class Account(LDAP):
             ('homeDirectory', [home])
         ]
 
+        return self.machineDN(name), attrs
+
+    def createSambaMachine(self, name, uid=None, gid=None, displayName=None,
+                           sambaSID=None, sambaPrimaryGroupSID=None,
+                           gecos=None, loginShell='/bin/false', home='/dev/null',
+                           sambaAcctFlags=None):
+        allocated = []
+        if not uid:
+            uid = self.allocateId('uidNumber')
+            allocated.append(('uidNumber', uid))
+
+        dn, attrs = self.sambaMachineAttrs(name, uid, gid, displayName,
+                                           sambaSID, sambaPrimaryGroupSID,
+                                           gecos, loginShell, home,
+                                           sambaAcctFlags)
+
         try:
             self.ldap_add(dn, attrs)
-            self.setNextFreeUid(str(int(uid) + 1))
             print dn + ': Successfully created'
+            allocated = []
         except ldap.ALREADY_EXISTS, e:
             print dn + ': Already exists'
+            self.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': No such object!'
+            self.failed(dn, e)
         except ldap.INVALID_SYNTAX, e:
             print dn + ': Invalid attribute syntax. Is samba3 schema installed?'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ':', e.args
+            self.failed(dn, e)
+
+        # the IDs of an entry not created are handed out again
+        self.releaseIds(allocated)
+
+    def prestageMachines(self, count, window=64):
+        '''Create count disabled Samba machine accounts ahead of time, to be
+           claimed by claimMachine when a machine joins. Their uids are
+           reserved as one block.'''
+        def added(dn, tag, error):
+            if error is None:
+                print dn + ': Successfully prestaged'
+            else:
+                print dn + ':', error.args
+                self.failed(dn, error)
+
+        first    = self.allocateIds('uidNumber', count)
+        pipeline = self.ldap_pipeline(window, added)
+
+        for uid in range(first, first + count):
+            dn, attrs = self.sambaMachineAttrs(self.prestagePrefix + str(uid),
+                                               str(uid),
+                                               sambaAcctFlags='[WD         ]')
+            pipeline.add(dn, attrs)
+        pipeline.flush()
+
+        print '%d machines prestaged, %d failed' % (pipeline.done -
+                                                    pipeline.errors,
+                                                    pipeline.errors)
+        if not self.claimsPrestaged():
+            print 'Joins claim them only with prestaged machines = yes in [samba]'
+
+    def claimsPrestaged(self):
+        '''Whether joins look for prestaged accounts, off by default as
+           the search for them is a substring match on uid'''
+        option = self.cfg.getOp('samba', 'prestaged machines') or 'no'
+        return option.lower() in ('yes', 'true', 'on', '1')
+
+    def claimMachine(self, name, displayName=None):
+        '''Turn a prestaged machine account into the account of machine
+           name, if [samba] prestaged machines is enabled. The rename claims
+           it, it fails if another join took it first. Then one modify sets
+           the names and enables the account, only if the entry still has
+           the prestaged values. Returns the new dn, None if no prestaged
+           account is left and False if the claim failed.'''
+        if not self.claimsPrestaged():
+            return None
 
-    def modifyMachine(self, name, attribute, value):
-        suffix         = self.cfg.getOp('samba', 'ldap suffix')
-        machine_suffix = self.cfg.getOp('samba', 'ldap machine suffix')
-
-        # appending '$' to the end of the name, marks it as a machine
-        m = re.match('.*\$$', name)
-        if not m:
+        if not name.endswith('$'):
             name = name + '$'
+        newdn  = self.machineDN(name)
+        filter = '(&(objectClass=sambaSamAccount)(uid=%s*))' % self.prestagePrefix
+
+        # concurrent joins start at different accounts
+        prestaged = [attrs['uid'][0] for dn, attrs in
+                     self.ldap_search_iter(self.machineBase(), filter, ['uid'],
+                                           ldap.SCOPE_ONELEVEL)
+                     if attrs.get('uid')]
+        random.shuffle(prestaged)
+
+        for uid in prestaged:
+            dn = self.machineDN(uid)
+            try:
+                self.ldap_rename(dn, 'uid=' + name)
+            except ldap.NO_SUCH_OBJECT, e:
+                # claimed by someone else meanwhile, try the next one
+                continue
+            except ldap.ALREADY_EXISTS, e:
+                print newdn + ': Already exists'
+                self.failed(newdn, e)
+                return False
+            except ldap.LDAPError, e:
+                print dn + ':', e.args
+                self.failed(dn, e)
+                return False
+
+            changes = [(ldap.MOD_DELETE, 'cn', [uid]),
+                       (ldap.MOD_ADD, 'cn', [name]),
+                       (ldap.MOD_DELETE, 'sn', [uid]),
+                       (ldap.MOD_ADD, 'sn', [name]),
+                       (ldap.MOD_REPLACE, 'displayName',
+                        [displayName or name.upper()]),
+                       (ldap.MOD_DELETE, 'sambaAcctFlags', ['[WD         ]']),
+                       (ldap.MOD_ADD, 'sambaAcctFlags', ['[W          ]'])]
+            try:
+                self.ldap_modify(newdn, changes)
+            except ldap.LDAPError, e:
+                print newdn + ':', e.args
+                self.failed(newdn, e)
+                try:
+                    self.ldap_rename(newdn, 'uid=' + uid)
+                    print '%s: Renamed back to %s' % (newdn, dn)
+                except ldap.LDAPError, e:
+                    print '%s: Could not rename back to %s:' % (newdn, dn), e.args
+                return False
+
+            print '%s: Successfully claimed %s' % (newdn, dn)
+            return newdn
+
+        return None
 
-        dn = 'uid=%s,%s,%s' % (name, machine_suffix, suffix)
-
-        try:
-            self.ldap_update_attribute(dn, attribute, [value])
-            print '%s: Successfully changed %s' % (dn, attribute)
-        except ldap.LDAPError, e:
-            print dn + ': ', e.args
+    def modifyMachine(self, name, attribute, value):
+        changes = self.machineChanges(name)
+        changes.replace(attribute, [value])
+        self.applyChanges(changes)
 
     def deleteMachine(self, name):
         suffix         = self.cfg.getOp('samba', 'ldap suffix')
@@ -706,6 +2107,7 @@ class Account(LDAP):
             print dn + ': Successfully deleted'
         except ldap.LDAPError, e:
             print dn + ': ', e.args
+            self.failed(dn, e)
 
     def addUserToGroup(self, username, groupname):
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
@@ -720,6 +2122,7 @@ class Account(LDAP):
             print '%s: %s is already a member' % (dn, username)
         except ldap.LDAPError, e:
             print dn + ': ', e.args
+            self.failed(dn, e)
 
     def deleteUserFromGroup(self, username, groupname):
         suffix       = self.cfg.getOp('samba', 'ldap suffix')
@@ -734,35 +2137,78 @@ class Account(LDAP):
             print '%s: %s is not a member' % (dn, username)
         except ldap.LDAPError, e:
             print dn + ': ', e, e.args
+            self.failed(dn, e)
+
+    def setGroupMembers(self, groupname, members, dryRun=False, chunk=1000):
+        '''Make members the memberUid values of a group. The current
+           members are read once and only the difference is sent, at most
+           chunk values per modify. With dryRun the difference is only
+           printed.'''
+        dn = self.groupDN(groupname)
+
+        # never sync against a cached member list
+        self.cache.discard(('members', groupname))
+        current = self.getGroupMembers(groupname)
+        if current is None:
+            print dn + ': No such object!'
+            self.failed(dn, 'No such object')
+            return
+
+        # memberUid compares case insensitive
+        currentKeys = set(member.lower() for member in current)
+        wanted      = collections.OrderedDict((member.lower(), member)
+                                              for member in members)
+        add    = [member for key, member in wanted.iteritems()
+                  if key not in currentKeys]
+        remove = [member for member in current
+                  if member.lower() not in wanted]
+
+        if dryRun:
+            for member in add:
+                print '+' + member
+            for member in remove:
+                print '-' + member
+            print '%s: %d to add, %d to remove' % (dn, len(add), len(remove))
+            return
+
+        for i in range(0, len(remove), chunk):
+            names = remove[i:i + chunk]
+            try:
+                self.ldap_del_attribute(dn, 'memberUid', names)
+                print '%s: Successfully removed %d members' % (dn, len(names))
+            except ldap.NO_SUCH_ATTRIBUTE, e:
+                # changed since it was read, fall back to one at a time
+                for name in names:
+                    self.deleteUserFromGroup(name, groupname)
+            except ldap.LDAPError, e:
+                print dn + ': ', e.args
+                self.failed(dn, e)
+
+        for i in range(0, len(add), chunk):
+            names = add[i:i + chunk]
+            try:
+                self.ldap_add_attribute(dn, 'memberUid', names)
+                print '%s: Successfully added %d members' % (dn, len(names))
+            except ldap.TYPE_OR_VALUE_EXISTS, e:
+                for name in names:
+                    self.addUserToGroup(name, groupname)
+            except ldap.LDAPError, e:
+                print dn + ': ', e.args
+                self.failed(dn, e)
 
     def createNTPassword(self, password):
-        hash = hashlib.new('md4', password.encode('utf-16le')).digest()
-        return binascii.hexlify(hash)
+        return createNTPassword(password)
 
     def createCryptPassword(self, password, digest='SSHA'):
-        digest = digest.upper()
-        crypt  = password
-        salt   = ''
-
-        for i in range(8):
-            salt += chr(random.randint(0, 255))
-
-        if digest == "SSHA":
-            crypt = "{SSHA}" + base64.encodestring(hashlib.sha1(password+salt).digest()+salt)
-        elif digest == "SHA":
-            crypt = "{SHA}" + base64.encodestring(hashlib.sha1(password).digest())
-        elif digest == "MD5":
-            crypt = "{MD5}" + base64.encodestring(hashlib.md5(password).digest())
-        elif digest == "CRYPT":
-            crypt = "{CRYPT}" + crypt.crypt(password, salt)
-
-        return crypt
-
-    def changeUserPassword(self, username, password, canChangePwd=None, mustChangePwd=None):
-        suffix        = self.cfg.getOp('samba', 'ldap suffix')
-        user_suffix   = self.cfg.getOp('samba', 'ldap user suffix')
-        ntpassword    = self.createNTPassword(password)
-        cryptpassword = self.createCryptPassword(password)
+        return createCryptPassword(password, digest)
+
+    def passwordChanges(self, changes, password, canChangePwd=None,
+                        mustChangePwd=None, ntpassword=None,
+                        cryptpassword=None):
+        '''Add the Unix and Samba password attributes to a ChangeSet. Hashes
+           computed already may be passed instead of the password.'''
+        ntpassword    = ntpassword or self.createNTPassword(password)
+        cryptpassword = cryptpassword or self.createCryptPassword(password)
         rightNow      = int(time.time())
 
         if canChangePwd:
@@ -778,41 +2224,956 @@ class Account(LDAP):
         shadowLastChange = str(rightNow/3600/24)        # days since Unix epoch
         sambaPwdLastSet  = str(rightNow)            # seconds since Unix epoch
 
-        dn = 'uid=%s,%s,%s' % (username, user_suffix, suffix)
+        changes.replace('UserPassword', cryptpassword)
+        changes.replace('shadowLastChange', shadowLastChange)
+        changes.replace('shadowExpire', mustChangePwd)
+        changes.replace('sambaNTPassword', ntpassword)
+        changes.replace('sambaPwdLastSet', sambaPwdLastSet)
+        changes.replace('sambaPwdMustChange', mustChangePwd)
+        changes.replace('sambaPwdCanChange', canChangePwd)
+
+        return changes
+
+    def changeUserPassword(self, username, password, canChangePwd=None, mustChangePwd=None):
+        changes = self.passwordChanges(self.userChanges(username), password,
+                                       canChangePwd, mustChangePwd)
+        dn      = changes.dn
 
         try:
-            self.ldap_update_attribute(dn, 'UserPassword', cryptpassword)
-            self.ldap_update_attribute(dn, 'shadowLastChange', shadowLastChange)
-            self.ldap_update_attribute(dn, 'shadowExpire', mustChangePwd)
+            skipped = changes.commit()
             print dn + ': Successfully changed Unix password'
+            if skipped:
+                # raised when object class is not sambaSamAccount
+                print dn + ': Not a samba account - Samba password not changed'
+            else:
+                print dn + ': Successfully changed Samba password'
         except ldap.NO_SUCH_OBJECT, e:
             print dn + ': does not exist!'
+            self.failed(dn, e)
+        except ldap.UNDEFINED_TYPE, e:
+            #FIXME: find a better way of printing exception info
+            print dn + ': ' + e[0]['info'] + '. Is samba3 schema installed?'
+            self.failed(dn, e)
         except ldap.LDAPError, e:
             print dn + ': ', e, e.args
+            self.failed(dn, e)
+
+class LDIFAccount(Account):
+    '''Account writing new entries as LDIF for slapadd instead of sending
+       them to a server. It never connects: IDs and SIDs are allocated
+       locally, starting from the [samba] uid, gid and rid options like a
+       new sambaDomain entry.
+
+       Users and containers are written as they are added. Groups and the
+       sambaDomain entry are kept until close, so members can still be added
+       and the ID counters are final; the last added entry is kept until the
+       next add, so e.g. a password can still be set. Other entries can not
+       be changed any more.'''
+    def __init__(self, configFile, out):
+        self.cfg         = Config(configFile)
+        self.out         = out
+        self.writer      = ldif.LDIFWriter(out)
+        self.domain      = None
+        self.domainAdded = False
+        self.idPools     = {}
+        self.idBlockSize = 1
+        self.idRetries   = 1
+        self.idMap       = None
+        self.cache       = LookupCache(ttl=0)
+        self.failures    = []
+        self.kept        = collections.OrderedDict()  # dn -> entry
+        self.pending     = None                       # (dn, entry)
+        self.written     = set()
+        self.results     = {}
+        self.msgid       = 0
+
+    def key(self, dn):
+        return dn.lower().replace(', ', ',')
+
+    def ldap_add(self, dn, attrs):
+        if self.key(dn) in self.written:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        self.written.add(self.key(dn))
+
+        entry = collections.OrderedDict()
+        for attribute, values in attrs:
+            if not isinstance(values, list):
+                values = [values]
+            entry[attribute] = list(values)
+
+        classes = [c.lower() for c in entry.get('objectClass', [])]
+        if self.key(dn) == self.key(self.domainDN()):
+            self.domain      = entry
+            self.domainAdded = True
+        elif 'posixgroup' in classes:
+            self.kept[self.key(dn)] = (dn, entry)
+        else:
+            self.writePending()
+            self.pending = (dn, entry)
+
+    def ldap_modify(self, dn, attrs):
+        if self.key(dn) == self.key(self.domainDN()):
+            entry = self.getDomain()
+        elif self.pending and self.key(self.pending[0]) == self.key(dn):
+            entry = self.pending[1]
+        elif self.key(dn) in self.kept:
+            entry = self.kept[self.key(dn)][1]
+        else:
+            raise ldap.UNWILLING_TO_PERFORM({'desc': dn + ' was written already'})
+
+        for op, attribute, values in attrs:
+            if values is not None and not isinstance(values, list):
+                values = [values]
+            current = entry.setdefault(attribute, [])
+            if op == ldap.MOD_REPLACE:
+                current[:] = values or []
+            elif op == ldap.MOD_ADD:
+                for value in values:
+                    if value in current:
+                        raise ldap.TYPE_OR_VALUE_EXISTS({'desc': 'Type or value exists'})
+                    current.append(value)
+            elif values is None:
+                del current[:]
+            else:
+                for value in values:
+                    if value not in current:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                    current.remove(value)
+            if not current:
+                del entry[attribute]
+
+    def ldap_del(self, dn):
+        raise ldap.UNWILLING_TO_PERFORM({'desc': 'can not delete in LDIF output'})
+
+    def ldap_rename(self, dn, newrdn):
+        raise ldap.UNWILLING_TO_PERFORM({'desc': 'can not rename in LDIF output'})
+
+    # the pipeline's asynchronous operations are done right away
+    def finished(self, function, dn, *args):
+        self.msgid += 1
+        try:
+            function(dn, *args)
+            self.results[self.msgid] = None
+        except ldap.LDAPError, e:
+            self.results[self.msgid] = e
+        return self.msgid
+
+    def ldap_add_async(self, dn, attrs):
+        return self.finished(self.ldap_add, dn, attrs)
+
+    def ldap_modify_async(self, dn, attrs):
+        return self.finished(self.ldap_modify, dn, attrs)
+
+    def ldap_del_async(self, dn):
+        return self.finished(self.ldap_del, dn)
+
+    def ldap_result(self, msgid, timeout=-1):
+        error = self.results.pop(msgid)
+        if error:
+            raise error
+        return ldap.RES_ANY, []
+
+    def ldap_search_iter(self, basedn, filter, attributes,
+                         scope=ldap.SCOPE_SUBTREE, pageSize=None):
+        # there is no server to ask
+        return iter([])
+
+    def readDomain(self):
+        if self.domain is not None:
+            # the local counters are the only copy
+            return self.domain
+
+        # the values createSambaDomain starts a new domain with
+        return collections.OrderedDict([
+            ('sambaSID', [self.cfg.getOp('samba', 'sambaSID')]),
+            ('uidNumber', [self.cfg.getOp('samba', 'uid') or '1000']),
+            ('gidNumber', [self.cfg.getOp('samba', 'gid') or '1000']),
+            ('sambaNextRid', [self.cfg.getOp('samba', 'rid') or '1000'])])
+
+    def reserveIds(self, attribute, count=1):
+        domain  = self.getDomain()
+        current = int(domain[attribute][0])
+        domain[attribute] = [str(current + count)]
+        return current
+
+    def allocateId(self, attribute):
+        # nobody else allocates, blocks would only leave gaps
+        return str(self.reserveIds(attribute))
+
+    def getGidName(self, gid):
+        for dn, entry in self.kept.itervalues():
+            if gid in entry.get('gidNumber', []):
+                return entry['cn'][0]
+
+    def getGroupMembers(self, groupname):
+        group = self.kept.get(self.key(self.groupDN(groupname)))
+        if group:
+            return group[1].get('memberUid', [])
+
+    def writePending(self):
+        if self.pending:
+            self.writer.unparse(*self.pending)
+            self.pending = None
+
+    def close(self):
+        '''Write the entries kept back. Without a sambaDomain entry in the
+           output the next free IDs are printed, to be set on the server.'''
+        self.writePending()
+        for dn, entry in self.kept.itervalues():
+            self.writer.unparse(dn, entry)
+        self.kept.clear()
+
+        domain = self.getDomain()
+        if self.domainAdded:
+            self.writer.unparse(self.domainDN(), domain)
+        else:
+            print '%s: next free uidNumber %s, gidNumber %s, sambaNextRid %s' % (
+                self.domainDN(), domain['uidNumber'][0],
+                domain['gidNumber'][0], domain['sambaNextRid'][0])
+
+        self.out.flush()
+
+class UserImport(object):
+    '''Create users from a CSV or LDIF stream, keeping a bounded window
+       of asynchronous adds outstanding on a single connection'''
+    # CSV columns which map to arguments of addUser and Account.userAttrs,
+    # uid is the login name
+    columns = { 'uidNumber': 'number', 'gidNumber': 'gid',
+                'homeDirectory': 'home' }
+
+    def __init__(self, account, samba=False, window=64, chunk=1000):
+        self.acc       = account
+        self.samba     = samba
+        self.window    = max(1, int(window))
+        self.chunk     = chunk
+        self.pipeline  = account.ldap_pipeline(self.window, self.created)
+        # reserve IDs on the server one window at a time
+        self.acc.idBlockSize = max(self.acc.idBlockSize, self.window)
+        self.members   = {}                   # gid -> names to add
+        self.groups    = {}                   # gid -> group name
+        self.domainSID = None
+        self.failed    = 0
+
+    def importFile(self, filename, fileFormat=None):
+        if not fileFormat:
+            if filename.lower().endswith('.ldif'):
+                fileFormat = 'ldif'
+            else:
+                fileFormat = 'csv'
+
+        if filename == '-':
+            f = sys.stdin
+        else:
+            f = open(filename, 'rb')
 
         try:
-            self.ldap_update_attribute(dn, 'sambaNTPassword', ntpassword)
-            self.ldap_update_attribute(dn, 'sambaPwdLastSet', sambaPwdLastSet)
-            self.ldap_update_attribute(dn, 'sambaPwdMustChange', mustChangePwd)
-            self.ldap_update_attribute(dn, 'sambaPwdCanChange', canChangePwd)
-            print dn + ': Successfully changed Samba password'
+            self.start()
+            if fileFormat.lower() == 'ldif':
+                _LDIFUserReader(f, self).parse()
+            else:
+                self.readCSV(f)
+            self.finish()
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            self.stop()
+
+        print '%d users created, %d failed' % self.counts()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        '''Release what start set up, also after errors'''
+        pass
+
+    def counts(self):
+        '''Return the number of created and of failed users'''
+        return (self.pipeline.done - self.pipeline.errors,
+                self.failed + self.pipeline.errors)
+
+    def readCSV(self, f):
+        reader = csv.DictReader(f)
+        for row in reader:
+            kwargs = {}
+            for column, value in row.iteritems():
+                if column is None or not value:
+                    continue
+                kwargs[self.columns.get(column, column)] = value.strip()
+
+            name = kwargs.pop('uid', None) or kwargs.pop('name', None)
+            if not name:
+                print 'line %d: no uid given' % reader.line_num
+                self.acc.failed(None, 'line %d: no uid given' % reader.line_num)
+                self.failed += 1
+                continue
+            self.addUser(name, **kwargs)
+
+    def addUser(self, name, **kwargs):
+        uid = kwargs.pop('number', None)
+        if not uid:
+            uid = self.acc.allocateId('uidNumber')
+        gid = kwargs.pop('gid', None)
+
+        sambaSID = kwargs.pop('sambaSID', None)
+        if self.samba and not sambaSID:
+            if self.domainSID is None:
+                self.domainSID = self.acc.getDomainSID()
+            sambaSID = '%s-%s' % (self.domainSID, self.acc.allocateId('sambaNextRid'))
+
+        dn, attrs = self.acc.userAttrs(name, uid, gid, sambaSID, **kwargs)
+        self.add(dn, attrs)
+
+    def add(self, dn, attrs):
+        name = attrs.get('uid', dn)
+        gid  = attrs.get('gidNumber')
+        if isinstance(name, list):
+            name = name[0]
+        if isinstance(gid, list):
+            gid = gid[0]
+
+        self.pipeline.add(dn, ldap.modlist.addModlist(attrs), (name, gid))
+
+    def created(self, dn, tag, error):
+        name, gid = tag
+
+        try:
+            if error:
+                raise error
+            print dn + ': Successfully created'
+        except ldap.ALREADY_EXISTS, e:
+            print dn + ': Already exists'
+            self.acc.failed(dn, e)
         except ldap.NO_SUCH_OBJECT, e:
-            print dn + ': does not exist!'
+            print dn + ': No such object!'
+            self.acc.failed(dn, e)
+        except ldap.INVALID_SYNTAX, e:
+            print dn + ': Invalid attribute syntax. Is samba3 schema installed?'
+            self.acc.failed(dn, e)
+        except ldap.LDAPError, e:
+            print dn + ':', e.args
+            self.acc.failed(dn, e)
+        else:
+            if gid:
+                names = self.members.setdefault(gid, [])
+                names.append(name)
+                if len(names) >= self.chunk:
+                    self.addMembers(gid)
+
+    def addMembers(self, gid):
+        names = self.members.pop(gid, [])
+        if gid not in self.groups:
+            self.groups[gid] = self.acc.getGidName(gid)
+        group = self.groups[gid]
+        if not group:
+            # e.g. LDIF output only knows the groups written with it
+            for name in names:
+                print '%s: no group with gidNumber %s found, memberUid %s not added' % (
+                    self.acc.userDN(name), gid, name)
+            return
+        if not names:
+            return
+
+        suffix       = self.acc.cfg.getOp('samba', 'ldap suffix')
+        group_suffix = self.acc.cfg.getOp('samba', 'ldap group suffix')
+        dn = 'cn=%s,%s,%s' % (group, group_suffix, suffix)
+
+        try:
+            self.acc.ldap_add_attribute(dn, 'memberUid', names)
+            print '%s: Successfully added %d members' % (dn, len(names))
+        except ldap.TYPE_OR_VALUE_EXISTS, e:
+            # some are members already, fall back to one at a time
+            for name in names:
+                self.acc.addUserToGroup(name, group)
+        except ldap.LDAPError, e:
+            print dn + ': ', e.args
+            self.acc.failed(dn, e)
+
+    def finish(self):
+        self.pipeline.flush()
+
+        for gid in self.members.keys():
+            self.addMembers(gid)
+
+class _LDIFUserReader(ldif.LDIFParser):
+    '''Feed entries of an LDIF file to a UserImport as they are parsed'''
+    def __init__(self, f, userImport):
+        ldif.LDIFParser.__init__(self, f)
+        self.userImport = userImport
+
+    def handle(self, dn, entry):
+        self.userImport.add(dn, entry)
+
+class PasswordRotation(object):
+    '''Change the passwords listed in a CSV file. Hashes are computed by a
+       process pool one batch at a time, while the modifies of the previous
+       batch are pipelined, one modify per user.'''
+    def __init__(self, account, window=64, canChangePwd=None,
+                 mustChangePwd=None):
+        self.acc           = account
+        self.pipeline      = account.ldap_pipeline(window, self.changed)
+        self.canChangePwd  = canChangePwd
+        self.mustChangePwd = mustChangePwd
+        self.succeeded     = 0
+        self.failed        = 0
+
+    def rotateFile(self, filename, processes=None, batch=1000):
+        '''Read uid and password columns, or uid, userPassword and
+           sambaNTPassword for hashed passwords, from a CSV file with a
+           header line (- for stdin)'''
+        if filename == '-':
+            f = sys.stdin
+        else:
+            f = open(filename, 'rb')
+
+        # reseed, the children would share the parent's salt sequence
+        pool = multiprocessing.Pool(processes, random.seed)
+        try:
+            # fork the pool before any threads run, see start
+            self.start()
+            # at most two batches of plaintext passwords are held at once
+            hashing = None
+            for rows in self.batches(csv.DictReader(f), batch):
+                result = pool.map_async(_hashPassword, rows)
+                if hashing:
+                    self.send(hashing.get())
+                hashing = result
+            if hashing:
+                self.send(hashing.get())
+            self.finish()
+        finally:
+            pool.terminate()
+            pool.join()
+            if f is not sys.stdin:
+                f.close()
+            self.stop()
+
+        print '%d passwords changed, %d failed' % self.counts()
+
+    def batches(self, reader, size):
+        rows = []
+        for row in reader:
+            uid = row.get('uid')
+            if not uid or not (row.get('password') or
+                               row.get('userPassword') and
+                               row.get('sambaNTPassword')):
+                print 'line %d: uid and password or userPassword and sambaNTPassword needed' % reader.line_num
+                self.acc.failed(None, 'line %d: no password' % reader.line_num)
+                self.failed += 1
+                continue
+
+            rows.append((reader.line_num, uid, row.get('password'),
+                         row.get('sambaNTPassword'), row.get('userPassword')))
+            if len(rows) >= size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    def start(self):
+        pass
+
+    def stop(self):
+        '''Release what start set up, also after errors'''
+        pass
+
+    def send(self, hashed):
+        for line, uid, ntpassword, cryptpassword, error in hashed:
+            if error:
+                print 'line %d: %s: %s' % (line, uid, error)
+                self.acc.failed(None, 'line %d: %s' % (line, error))
+                self.failed += 1
+            else:
+                self.change(uid, ntpassword, cryptpassword)
+
+    def change(self, uid, ntpassword, cryptpassword):
+        changes = self.acc.passwordChanges(self.acc.userChanges(uid), None,
+                                           self.canChangePwd,
+                                           self.mustChangePwd,
+                                           ntpassword, cryptpassword)
+        self.pipeline.modify(changes.dn, changes.mods, changes)
+
+    def changed(self, dn, changes, error):
+        try:
+            if error:
+                raise error
+            print dn + ': Successfully changed password'
         except ldap.OBJECT_CLASS_VIOLATION, e:
-            # this exception is raised when object class is not sambaSamAccount
-            print dn + ': Not a samba account - Samba password not changed'
-        except ldap.UNDEFINED_TYPE, e:
-            #FIXME: find a better way of printing exception info
-            print dn + ': ' + e[0]['info'] + '. Is samba3 schema installed?'
+            # not a sambaSamAccount, change the Unix password only
+            try:
+                self.acc.ldap_modify(dn, [m for m in changes.mods
+                                          if not changes.isSamba(m[1])])
+                print dn + ': Successfully changed Unix password'
+                print dn + ': Not a samba account - Samba password not changed'
+            except ldap.LDAPError, e:
+                print dn + ': ', e.args
+                self.acc.failed(dn, e)
+                self.failed += 1
+                return
+        except ldap.NO_SUCH_OBJECT, e:
+            print dn + ': does not exist!'
+            self.acc.failed(dn, e)
+            self.failed += 1
+            return
         except ldap.LDAPError, e:
-            print dn + ': ', e, e.args
+            print dn + ': ', e.args
+            self.acc.failed(dn, e)
+            self.failed += 1
+            return
+
+        self.succeeded += 1
+
+    def finish(self):
+        self.pipeline.flush()
+
+    def counts(self):
+        '''Return the number of changed and of failed passwords'''
+        return self.succeeded, self.failed
+
+class ParallelPasswordRotation(PasswordRotation):
+    '''PasswordRotation spreading the modifies over several connections'''
+    def __init__(self, configFile, workers=4, window=64, canChangePwd=None,
+                 mustChangePwd=None, cache=None):
+        self.failed     = 0
+        self.executor   = None
+        self.configFile = configFile
+        self.workers    = workers
+        self.cache      = cache
+        self.rotation   = (window, canChangePwd, mustChangePwd)
+
+    def start(self):
+        '''Connect the sessions and start their threads. Forking a process
+           with running threads can deadlock the children, so rotateFile
+           calls this only once its process pool exists.'''
+        if self.executor is None:
+            self.executor = ParallelExecutor(self.configFile, self.workers,
+                                lambda acc: PasswordRotation(acc,
+                                                             *self.rotation),
+                                self.cache)
+            self.executor.start()
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.join()
+
+    @property
+    def acc(self):
+        # failures of the file's lines are noted on the first session
+        return self.executor.states[0].acc
+
+    def change(self, uid, ntpassword, cryptpassword):
+        self.executor.submit(uid, PasswordRotation.change, uid, ntpassword,
+                             cryptpassword)
+
+    def finish(self):
+        self.start()
+        self.executor.each(PasswordRotation.finish)
+        done, errors = self.executor.join()
+        self.failed += errors
+
+    def counts(self):
+        succeeded = 0
+        failed    = self.failed
+        for rotation in self.executor and self.executor.states or []:
+            s, f = rotation.counts()
+            succeeded += s
+            failed    += f
+        return succeeded, failed
+
+class ThreadOutput(object):
+    '''sys.stdout/sys.stderr replacement sending the output of a thread
+       to that thread's buffer'''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local  = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'buffer', None) or self.stream
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+    # the print statement keeps its state in softspace, keep it per thread
+    def _getSoftspace(self):
+        return getattr(self.local, 'softspace', 0)
+
+    def _setSoftspace(self, value):
+        self.local.softspace = value
+
+    softspace = property(_getSoftspace, _setSoftspace)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class ParallelExecutor(object):
+    '''Run work on several bound Account sessions at once, one thread per
+       session.
+
+       Work submitted with the same key (usually a dn) goes to the same
+       session and runs in submission order, so e.g. adding a user and
+       then adding it to a group never race. function(state, *args) is
+       called with the state of its worker: the Account, or what
+       factory(account) returned for it.'''
+    def __init__(self, configFile, workers=4, factory=None, cache=None,
+                 queueSize=1024):
+        self.workers = max(1, int(workers))
+        self.states  = []
+        self.queues  = []
+        self.threads = []
+        self.lock    = threading.Lock()
+        self.done    = 0
+        self.errors  = 0
+
+        for i in range(self.workers):
+            # all sessions share one lookup cache, see the daemon pool
+            acc   = Account(configFile, cache)
+            cache = acc.cache
+            # and one map of used IDs, so they never hand out the same gap
+            if i:
+                acc.idMap = idMap
+            idMap = acc.idMap
+            self.states.append(factory(acc) if factory else acc)
+            self.queues.append(Queue.Queue(queueSize))
+        self.stdout = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.join()
+
+    def start(self):
+        '''Start the worker threads, done by the first submit. Until join
+           sys.stdout is a ThreadOutput, so the output of one work item is
+           written in one piece.'''
+        if self.threads:
+            return
+        self.stdout = sys.stdout
+        sys.stdout  = ThreadOutput(self.stdout)
+        try:
+            for i in range(self.workers):
+                t = threading.Thread(target=self.work, args=(i,))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        except:
+            self.join()
+            raise
+
+    def worker(self, key):
+        return zlib.crc32(key) % self.workers
+
+    def submit(self, key, function, *args, **kwargs):
+        self.start()
+        self.queues[self.worker(key)].put((key, function, args, kwargs))
+
+    def each(self, function, *args, **kwargs):
+        '''Run function on every worker after the work submitted so far'''
+        self.start()
+        for queue in self.queues:
+            queue.put((None, function, args, kwargs))
+
+    def work(self, i):
+        state = self.states[i]
+        queue = self.queues[i]
+
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            key, function, args, kwargs = item
+
+            output = StringIO.StringIO()
+            sys.stdout.capture(output)
+            error = False
+            try:
+                function(state, *args, **kwargs)
+            except Exception, e:
+                print '%s: %s' % (key or 'worker %d' % i, e)
+                error = True
+            finally:
+                sys.stdout.capture(None)
+
+            with self.lock:
+                self.done += 1
+                self.errors += error
+                self.stdout.write(output.getvalue())
+
+    def join(self):
+        '''Wait until all work is done and restore sys.stdout, returns the
+           number of work items done and failed'''
+        if not self.threads:
+            return self.done, self.errors
+
+        try:
+            for queue in self.queues:
+                queue.put(None)
+            for t in self.threads:
+                t.join()
+        finally:
+            sys.stdout   = self.stdout
+            self.threads = []
+
+        return self.done, self.errors
+
+class ParallelUserImport(UserImport):
+    '''UserImport spreading users over several connections, each feeding
+       its own UserImport pipeline'''
+    def __init__(self, configFile, workers=4, samba=False, window=64,
+                 chunk=1000, cache=None):
+        self.failed     = 0
+        self.executor   = None
+        self.configFile = configFile
+        self.workers    = workers
+        self.cache      = cache
+        self.settings   = (samba, window, chunk)
+
+    def start(self):
+        '''Connect the sessions and start their threads, once the input is
+           open'''
+        if self.executor is None:
+            self.executor = ParallelExecutor(self.configFile, self.workers,
+                                lambda acc: UserImport(acc, *self.settings),
+                                self.cache)
+            self.executor.start()
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.join()
+
+    @property
+    def acc(self):
+        # failures of the file's lines are noted on the first session
+        return self.executor.states[0].acc
+
+    def addUser(self, name, **kwargs):
+        self.executor.submit(name, UserImport.addUser, name, **kwargs)
+
+    def add(self, dn, attrs):
+        self.executor.submit(dn, UserImport.add, dn, attrs)
+
+    def finish(self):
+        self.start()
+        self.executor.each(UserImport.finish)
+        done, errors = self.executor.join()
+        self.failed += errors
+
+    def counts(self):
+        created = 0
+        failed  = self.failed
+        for imp in self.executor and self.executor.states or []:
+            c, f = imp.counts()
+            created += c
+            failed  += f
+        return created, failed
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    # the futures backport is not installed, the part AsyncAccount needs
+    class Future(object):
+        '''Result of a call running in another thread'''
+        def __init__(self):
+            self.condition = threading.Condition()
+            self.finished  = False
+            self.value     = None
+            self.error     = None
+            self.callbacks = []
+
+        def set_running_or_notify_cancel(self):
+            return True
+
+        def done(self):
+            return self.finished
+
+        def result(self, timeout=None):
+            self.wait(timeout)
+            if self.error is not None:
+                raise self.error
+            return self.value
+
+        def exception(self, timeout=None):
+            self.wait(timeout)
+            return self.error
+
+        def add_done_callback(self, callback):
+            with self.condition:
+                if not self.finished:
+                    self.callbacks.append(callback)
+                    return
+            callback(self)
+
+        def set_result(self, value):
+            self.finish(value, None)
+
+        def set_exception(self, error):
+            self.finish(None, error)
+
+        def wait(self, timeout):
+            with self.condition:
+                if not self.finished:
+                    self.condition.wait(timeout)
+                if not self.finished:
+                    raise RuntimeError('timed out after %s seconds' % timeout)
+
+        def finish(self, value, error):
+            with self.condition:
+                self.value     = value
+                self.error     = error
+                self.finished  = True
+                self.condition.notify_all()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+class Result(object):
+    '''Outcome of an AsyncAccount call: the value the Account method
+       returned, what it printed and the operations it reported as failed,
+       (dn, error) as noted by Account.failed'''
+    def __init__(self, value, output, errors):
+        self.value  = value
+        self.output = output
+        self.errors = errors
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def messages(self):
+        return self.output.splitlines()
+
+class AsyncAccount(object):
+    '''Account operations for servers handling many requests at once.
+       Every method returns a Future immediately and runs on one of a few
+       bound sessions, so the caller never blocks on LDAP. The Future
+       yields a Result instead of printing; exceptions are raised by its
+       result(). Calls for the same entry run in order on one session.
+
+       Event loops pick the result up with add_done_callback, which runs
+       in the session thread. Call close when done.
+
+       To capture the output of the sessions sys.stdout is replaced with a
+       ThreadOutput from construction until close. Other threads still
+       write to the original stream through it, but code replacing or
+       comparing sys.stdout meanwhile sees the wrapper.'''
+    def __init__(self, configFile, connections=4, cache=None):
+        # the queues are unbounded, so submitting never blocks
+        self.executor = ParallelExecutor(configFile, connections, None,
+                                         cache, 0)
+        self.executor.start()
+
+    def call(self, key, method, *args, **kwargs):
+        future = Future()
+        self.executor.submit(key, self.run, future, method, *args, **kwargs)
+        return future
+
+    def run(self, acc, future, method, *args, **kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        output = StringIO.StringIO()
+        sys.stdout.capture(output)
+        del acc.failures[:]
+        try:
+            value = getattr(acc, method)(*args, **kwargs)
+        except Exception, e:
+            future.set_exception(e)
+            return
+        finally:
+            sys.stdout.capture(None)
+
+        future.set_result(Result(value, output.getvalue(), list(acc.failures)))
+
+    def close(self):
+        '''Finish the submitted calls and stop the sessions'''
+        self.executor.join()
+
+    def userDN(self, name):
+        return self.executor.states[0].userDN(name)
+
+    def groupDN(self, name):
+        return self.executor.states[0].groupDN(name)
+
+    def machineDN(self, name):
+        return self.executor.states[0].machineDN(name)
+
+    def getUser(self, name, attributes=None):
+        return self.call(self.userDN(name), 'getUser', name, attributes)
+
+    def createPosixUser(self, name, **kwargs):
+        return self.call(self.userDN(name), 'createPosixUser', name, **kwargs)
+
+    def createSambaUser(self, name, **kwargs):
+        return self.call(self.userDN(name), 'createSambaUser', name, **kwargs)
+
+    def modifyUser(self, name, attribute, value):
+        return self.call(self.userDN(name), 'modifyUser', name, attribute,
+                         value)
+
+    def deleteUser(self, name):
+        return self.call(self.userDN(name), 'deleteUser', name)
+
+    def changeUserPassword(self, name, password, canChangePwd=None,
+                           mustChangePwd=None):
+        return self.call(self.userDN(name), 'changeUserPassword', name,
+                         password, canChangePwd, mustChangePwd)
+
+    def createPosixGroup(self, name, gid=None, description=None):
+        return self.call(self.groupDN(name), 'createPosixGroup', name, gid,
+                         description)
+
+    def createSambaGroup(self, name, gid=None, **kwargs):
+        return self.call(self.groupDN(name), 'createSambaGroup', name, gid,
+                         **kwargs)
+
+    def modifyGroup(self, name, attribute, value):
+        return self.call(self.groupDN(name), 'modifyGroup', name, attribute,
+                         value)
+
+    def deleteGroup(self, name):
+        return self.call(self.groupDN(name), 'deleteGroup', name)
+
+    # membership changes are ordered per group
+    def addUserToGroup(self, username, groupname):
+        return self.call(self.groupDN(groupname), 'addUserToGroup', username,
+                         groupname)
+
+    def deleteUserFromGroup(self, username, groupname):
+        return self.call(self.groupDN(groupname), 'deleteUserFromGroup',
+                         username, groupname)
+
+    def setGroupMembers(self, groupname, members, dryRun=False):
+        return self.call(self.groupDN(groupname), 'setGroupMembers', groupname,
+                         members, dryRun)
+
+    def createPosixMachine(self, name, **kwargs):
+        return self.call(self.machineDN(name), 'createPosixMachine', name,
+                         **kwargs)
+
+    def createSambaMachine(self, name, **kwargs):
+        return self.call(self.machineDN(name), 'createSambaMachine', name,
+                         **kwargs)
+
+    def modifyMachine(self, name, attribute, value):
+        return self.call(self.machineDN(name), 'modifyMachine', name,
+                         attribute, value)
+
+    def deleteMachine(self, name):
+        return self.call(self.machineDN(name), 'deleteMachine', name)
 
 class Population(object):
     '''Populate LDAP directory with initial Samba configuration,
        domain groups, and basic users'''
-    def __init__(self, configFile):
+    def __init__(self, configFile, account=None):
         self.cfg = Config(configFile)
-        self.smb = Account(configFile)
+        self.smb = account or Account(configFile)
 
     def createSambaDomain(self):
         self.smb.createSambaDomain()
@@ -987,14 +3348,95 @@ class Population(object):
         except ldap.LDAPError, e:
             print dn + ': ', e.args
 
+# Account shared by the commands of a session (daemon worker thread)
+_session = threading.local()
+
+def getAccount():
+    '''Return the Account of the current session or connect a new one'''
+    acc = getattr(_session, 'account', None)
+    if acc is None:
+        acc = Account(cfgfile)
+    return acc
+
+def setAccount(acc):
+    '''Make commands of the current thread use acc instead of connecting'''
+    _session.account = acc
+
+def ldifOutput(filename):
+    '''Open the output of --ldif, with - LDIF goes to stdout and the
+       messages to stderr'''
+    if filename == '-':
+        out = sys.stdout
+        sys.stdout = sys.stderr
+        return out
+    return open(filename, 'w')
+
+def closeLDIF(acc, filename):
+    acc.close()
+    if filename == '-':
+        sys.stdout = acc.out
+    else:
+        acc.out.close()
+
 def do_population(argv):
-    p = Population(cfgfile)
+    usage = '%prog populate [-h | --help] [Options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--ldif", dest='ldif', help='write the entries as LDIF for slapadd to this file (- for stdout) instead of adding them')
+
+    (options, args) = parser.parse_args(argv)
+
+    acc = None
+    if options.ldif:
+        acc = LDIFAccount(cfgfile, ldifOutput(options.ldif))
+
+    p = Population(cfgfile, acc)
     p.createRootDN()
     p.createSambaDomain()
     p.createContainers()
     p.createSambaGroups()
     p.createSambaUsers()
 
+    if acc:
+        closeLDIF(acc, options.ldif)
+
+def readNames(filename):
+    '''Return the names in a file, one per line (- for stdin). Empty lines
+       and lines starting with # are skipped.'''
+    if filename == '-':
+        f = sys.stdin
+    else:
+        f = open(filename)
+
+    try:
+        names = [line.strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    return [name for name in names if name and not name.startswith('#')]
+
+def add_list_options(parser):
+    parser.add_option("-l", "--list", dest='list', help='list entries, one per line', action='store_true')
+    parser.add_option("--filter", dest='filter', help='LDAP filter restricting the listed entries (with --list)')
+    parser.add_option("--attrs", dest='attrs', help='comma separated attributes to list, * for all (with --list)')
+    parser.add_option("--output", dest='output', help='list output format: json (default) or tsv', default='json', choices=['json', 'tsv'])
+
+def list_entries(acc, options, basedn, objectClass, attributes):
+    filter = '(objectClass=%s)' % objectClass
+    if options.filter:
+        userFilter = options.filter
+        if not userFilter.startswith('('):
+            userFilter = '(' + userFilter + ')'
+        filter = '(&%s%s)' % (filter, userFilter)
+
+    if options.attrs:
+        attributes = [a.strip() for a in options.attrs.split(',') if a.strip()]
+
+    if attributes == ['*'] and options.output == 'tsv':
+        raise optparse.OptionValueError('--attrs * can not be used with TSV output')
+
+    acc.listEntries(basedn, filter, attributes, options.output)
+
 def manage_user(argv):
     usage = '%prog user [-h | --help] | <name> [Options]'
     parser = optparse.OptionParser(usage)
@@ -1018,23 +3460,71 @@ def manage_user(argv):
     parser.add_option("-D", "--sambaHomeDrive", dest='sambaHomeDrive', help='Windows home drive letter (H:)')
     parser.add_option("-F", "--sambaProfilePath", dest='sambaProfilePath', help='profile directory (\\\\PDC\\profiles\\user)')
     parser.add_option("-E", "--sambaLogonScript", dest='sambaLogonScript', help='DOS script to execute on login')
-    parser.add_option("-A", "--canChangePassword", dest='canChangePassword', help='days after which user is allowed to change password (with --askPassword)')
-    parser.add_option("-B", "--mustChangePassword", dest='mustChangePassword', help='days after which user must change password (with --askPassword)')
+    parser.add_option("-A", "--canChangePassword", dest='canChangePassword', help='days after which user is allowed to change password (with --askPassword or --passwords-from)')
+    parser.add_option("-B", "--mustChangePassword", dest='mustChangePassword', help='days after which user must change password (with --askPassword or --passwords-from)')
     parser.add_option("-X", "--accountDisabled", dest='accountDisabled', help='user account is disabled', action='store_true')
     parser.add_option("-Y", "--accountEnabled", dest='accountDisabled', help='user account is disabled', action='store_false')
+    parser.add_option("-i", "--import", dest='importFile', help='create users from a CSV or LDIF file (- for stdin)')
+    parser.add_option("--format", dest='fileFormat', help='format of the import file: csv or ldif (default: by extension)')
+    parser.add_option("--passwords-from", dest='passwordsFrom', help='change the passwords listed in a CSV file with uid and password (or hashed userPassword and sambaNTPassword) columns (- for stdin)')
+    parser.add_option("--processes", dest='processes', help='number of processes hashing passwords (with --passwords-from, default: number of CPUs)', type='int')
+    parser.add_option("--delete-from", dest='deleteFrom', help='delete the users listed in a file, one name per line (- for stdin)')
+    parser.add_option("--ldif", dest='ldif', help='write the imported users as LDIF for slapadd to this file (- for stdout) instead of adding them (with -i)')
+    parser.add_option("--window", dest='window', help='number of operations kept outstanding during import and --delete-from (default: 64)', type='int', default=64)
+    parser.add_option("--workers", dest='workers', help='number of LDAP connections used in parallel during import and --passwords-from (default: 1)', type='int', default=1)
+    add_list_options(parser)
 
     (options, args) = parser.parse_args(argv)
     
+    actions = [a for a in (options.add, options.delete, options.modify,
+                           options.importFile, options.deleteFrom,
+                           options.passwordsFrom, options.list) if a]
     if options.add and options.delete:
         parser.error('options -a and -d are mutually exclusive')
     if options.add and options.modify:
         parser.error('options -a and -m are mutually exclusive')
     if options.delete and options.modify:
         parser.error('options -d and -m are mutually exclusive')
-    if not options.add and not options.delete and not options.modify:
+    if options.importFile and len(actions) > 1:
+        parser.error('option -i can not be combined with -a, -d or -m')
+    if options.deleteFrom and len(actions) > 1:
+        parser.error('option --delete-from can not be combined with other actions')
+    if options.passwordsFrom and len(actions) > 1:
+        parser.error('option --passwords-from can not be combined with other actions')
+    if options.ldif and not options.importFile:
+        parser.error('option --ldif requires -i')
+    if options.list and len(actions) > 1:
+        parser.error('option -l can not be combined with other actions')
+    if not actions:
         parser.error('Please specify an action! Use option --help')
 
-    acc = Account(cfgfile)
+    if options.ldif:
+        # offline, do not connect
+        acc = LDIFAccount(cfgfile, ldifOutput(options.ldif))
+        imp = UserImport(acc, samba=options.sambaAccount)
+        imp.importFile(options.importFile, options.fileFormat)
+        closeLDIF(acc, options.ldif)
+        return
+
+    acc = getAccount()
+
+    if options.list:
+        try:
+            list_entries(acc, options, acc.userBase(), 'posixAccount',
+                         ['uid', 'uidNumber', 'gidNumber', 'cn',
+                          'homeDirectory', 'loginShell'])
+        except optparse.OptionValueError, e:
+            parser.error(str(e))
+
+    if options.importFile:
+        if options.workers > 1:
+            imp = ParallelUserImport(cfgfile, options.workers,
+                                     samba=options.sambaAccount,
+                                     window=options.window, cache=acc.cache)
+        else:
+            imp = UserImport(acc, samba=options.sambaAccount,
+                             window=options.window)
+        imp.importFile(options.importFile, options.fileFormat)
 
     if options.add:
         uid = None; gid = None; sambaAcctFlags=None
@@ -1064,9 +3554,6 @@ def manage_user(argv):
             acc.createPosixUser(name=options.add, uid=uid, gid=gid,
                                   loginShell=options.loginShell)
 
-        uid = acc.getUserUid(options.add)
-        gid = acc.getUserGid(options.add)
-
         if options.groupName:
             for id, groupname in enumerate(options.groupName):
                 acc.addUserToGroup(options.add, groupname)
@@ -1079,6 +3566,22 @@ def manage_user(argv):
     if options.delete:
         acc.deleteUser(options.delete)
 
+    if options.deleteFrom:
+        acc.deleteUsers(readNames(options.deleteFrom), options.window)
+
+    if options.passwordsFrom:
+        if options.workers > 1:
+            rotation = ParallelPasswordRotation(cfgfile, options.workers,
+                                                options.window,
+                                                options.canChangePassword,
+                                                options.mustChangePassword,
+                                                acc.cache)
+        else:
+            rotation = PasswordRotation(acc, options.window,
+                                        options.canChangePassword,
+                                        options.mustChangePassword)
+        rotation.rotateFile(options.passwordsFrom, options.processes)
+
     if options.modify:
         if options.groupName:
             for groupname in options.groupName:
@@ -1087,35 +3590,40 @@ def manage_user(argv):
                 else:
                     acc.addUserToGroup(options.modify, groupname)
 
+        # all attribute changes are sent in one modify
+        changes = acc.userChanges(options.modify)
+
         if options.uidNumber:
-            acc.modifyUser(options.modify, 'uidNumber', options.uidNumber)
+            changes.replace('uidNumber', [options.uidNumber])
         if options.gidNumber:
-            acc.modifyUser(options.modify, 'gidNumber', options.gidNumber)
+            changes.replace('gidNumber', [options.gidNumber])
         if options.askPassword:
             password = getpass.getpass('Password for ' + options.modify + ': ')
-            acc.changeUserPassword(options.modify, password,
-                                     options.canChangePassword,
-                                     options.mustChangePassword)
+            acc.passwordChanges(changes, password,
+                                options.canChangePassword,
+                                options.mustChangePassword)
         if options.home:
-            acc.modifyUser(options.modify, 'homeDirectory', options.home)
+            changes.replace('homeDirectory', [options.home])
         if options.loginShell:
-            acc.modifyUser(options.modify, 'loginShell', options.loginShell)
+            changes.replace('loginShell', [options.loginShell])
         if options.givenName:
-            acc.modifyUser(options.modify, 'givenName', options.givenName)
+            changes.replace('givenName', [options.givenName])
         if options.sn:
-            acc.modifyUser(options.modify, 'sn', options.sn)
+            changes.replace('sn', [options.sn])
         if options.sambaHomePath:
-            acc.modifyUser(options.modify, 'sambaHomePath', options.sambaHomePath)
+            changes.replace('sambaHomePath', [options.sambaHomePath])
         if options.sambaHomeDrive:
-            acc.modifyUser(options.modify, 'sambaHomeDrive', options.sambaHomeDrive)
+            changes.replace('sambaHomeDrive', [options.sambaHomeDrive])
         if options.sambaProfilePath:
-            acc.modifyUser(options.modify, 'sambaProfilePath', options.sambaProfilePath)
+            changes.replace('sambaProfilePath', [options.sambaProfilePath])
         if options.sambaLogonScript:
-            acc.modifyUser(options.modify, 'sambaLogonScript', options.sambaLogonScript)
+            changes.replace('sambaLogonScript', [options.sambaLogonScript])
         if options.accountDisabled == True:
-            acc.modifyUser(options.modify, 'sambaAcctFlags', '[UD         ]')
+            changes.replace('sambaAcctFlags', ['[UD         ]'])
         if options.accountDisabled == False:
-            acc.modifyUser(options.modify, 'sambaAcctFlags', '[U         ]')
+            changes.replace('sambaAcctFlags', ['[U          ]'])
+
+        acc.applyChanges(changes)
 
 def manage_group(argv):
     usage = '%prog group [-h | --help] | -n <name> [Options]'
@@ -1129,19 +3637,37 @@ def manage_group(argv):
     parser.add_option("-t", "--type", dest='groupType', help='Samba group type')
     parser.add_option("-N", "--displayName", dest='displayName', help='Windows full display name')
     parser.add_option("-c", "--description", dest='description', help='group description')
+    parser.add_option("--set-members", dest='setMembers', help='make the users listed in FILE, one per line (- for stdin), the members of group NAME', nargs=2, metavar='NAME FILE')
+    parser.add_option("--dry-run", dest='dryRun', help='only print the membership changes (with --set-members)', action='store_true')
+    add_list_options(parser)
 
     (options, args) = parser.parse_args(argv)
 
+    actions = [a for a in (options.add, options.delete, options.modify,
+                           options.setMembers, options.list) if a]
     if options.add and options.delete:
         parser.error('options -a and -d are mutually exclusive')
     if options.add and options.modify:
         parser.error('options -a and -m are mutually exclusive')
     if options.delete and options.modify:
         parser.error('options -d and -m are mutually exclusive')
-    if not options.add and not options.delete and not options.modify:
+    if options.list and len(actions) > 1:
+        parser.error('option -l can not be combined with other actions')
+    if options.setMembers and len(actions) > 1:
+        parser.error('option --set-members can not be combined with other actions')
+    if options.dryRun and not options.setMembers:
+        parser.error('option --dry-run requires --set-members')
+    if not actions:
         parser.error('Please specify an action! Use option --help')
 
-    acc = Account(cfgfile)
+    acc = getAccount()
+
+    if options.list:
+        try:
+            list_entries(acc, options, acc.groupBase(), 'posixGroup',
+                         ['cn', 'gidNumber', 'sambaSID', 'description'])
+        except optparse.OptionValueError, e:
+            parser.error(str(e))
 
     # add new group
     if options.add:
@@ -1159,16 +3685,24 @@ def manage_group(argv):
 
     # modify existing group
     if options.modify:
+        changes = acc.groupChanges(options.modify)
+
         if options.gidNumber:
-            acc.modifyGroup(options.modify, 'gidNumber', options.gidNumber)
+            changes.replace('gidNumber', [options.gidNumber])
         if options.sambaSID:
-            acc.modifyGroup(options.modify, 'sambaSID', options.sambaSID)
+            changes.replace('sambaSID', [options.sambaSID])
         if options.groupType:
-            acc.modifyGroup(options.modify, 'sambaGroupType', options.groupType)
+            changes.replace('sambaGroupType', [options.groupType])
         if options.displayName:
-            acc.modifyGroup(options.modify, 'displayName', options.displayName)
+            changes.replace('displayName', [options.displayName])
         if options.description:
-            acc.modifyGroup(options.modify, 'description', options.description)
+            changes.replace('description', [options.description])
+
+        acc.applyChanges(changes)
+
+    if options.setMembers:
+        groupname, filename = options.setMembers
+        acc.setGroupMembers(groupname, readNames(filename), options.dryRun)
 
 def manage_machine(argv):
     usage = '%prog machine [-h | --help] | -n <name> [Options]'
@@ -1182,28 +3716,50 @@ def manage_machine(argv):
     parser.add_option("-S", "--sambaAccount", dest='sambaAccount', help='is a Samba machine (otherwise Posix only)', action='store_true')
     parser.add_option("-N", "--displayName", dest='displayName', help='Windows full display name')
     parser.add_option("-s", "--sambaSid", dest='sambaSID', help='machine sambaSID')
+    parser.add_option("--prestage", dest='prestage', help='create N disabled Samba machine accounts, which -a -S then claims instead of creating a new one', type='int', metavar='N')
+    add_list_options(parser)
 
     (options, args) = parser.parse_args(argv)
 
+    actions = [a for a in (options.add, options.delete, options.modify,
+                           options.prestage, options.list) if a]
     if options.add and options.delete:
         parser.error('options -a and -d are mutually exclusive')
     if options.add and options.modify:
         parser.error('options -a and -m are mutually exclusive')
     if options.delete and options.modify:
         parser.error('options -d and -m are mutually exclusive')
-    if not options.name:
+    if options.list and len(actions) > 1:
+        parser.error('option -l can not be combined with other actions')
+    if options.prestage and len(actions) > 1:
+        parser.error('option --prestage can not be combined with other actions')
+    if not options.name and not options.list and not options.prestage:
         parser.error('Name is missing! Use option --help')
-    if not options.add and not options.delete and not options.modify:
+    if not actions:
         parser.error('Please specify an action! Use option --help')
 
-    acc = Account(cfgfile)
+    acc = getAccount()
+
+    if options.list:
+        try:
+            list_entries(acc, options, acc.machineBase(), 'posixAccount',
+                         ['uid', 'uidNumber', 'gidNumber', 'sambaSID'])
+        except optparse.OptionValueError, e:
+            parser.error(str(e))
+
+    if options.prestage:
+        acc.prestageMachines(options.prestage)
 
-    # add new machine
+    # add new machine, a prestaged one is taken unless IDs are given
     if options.add:
+        claim = not (options.uidNumber or options.gidNumber or
+                     options.sambaSID)
         if options.sambaAccount:
-            acc.createSambaMachine(options.name, options.uidNumber,
-                                     options.gidNumber, options.displayName,
-                                     options.sambaSID)
+            if not claim or acc.claimMachine(options.name,
+                                             options.displayName) is None:
+                acc.createSambaMachine(options.name, options.uidNumber,
+                                         options.gidNumber, options.displayName,
+                                         options.sambaSID)
         else:
             acc.createPosixMachine(options.name, options.uidNumber,
                                      options.gidNumber, options.displayName)
@@ -1214,18 +3770,147 @@ def manage_machine(argv):
 
     # modify existing machine
     if options.modify:
+        changes = acc.machineChanges(options.name)
+
         if options.uidNumber:
-            acc.modifyMachine(options.name, 'uidNumber', options.uidNumber)
+            changes.replace('uidNumber', [options.uidNumber])
         if options.gidNumber:
-            acc.modifyMachine(options.name, 'gidNumber', options.gidNumber)
+            changes.replace('gidNumber', [options.gidNumber])
         if options.displayName:
-            acc.modifyMachine(options.name, 'displayName', options.displayName)
+            changes.replace('displayName', [options.displayName])
         if options.sambaSID:
-            acc.modifyMachine(options.name, 'sambaSID', options.sambaSID)
+            changes.replace('sambaSID', [options.sambaSID])
+
+        acc.applyChanges(changes)
+
+def do_batch(argv):
+    usage = '%prog batch [-h | --help] [Options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("-f", "--file", dest='file', help='file with one user, group or machine command per line (default: - for stdin)', default='-')
+    parser.add_option("-k", "--keep-going", dest='keepGoing', help='continue after a failed line (default: stop)', action='store_true')
+
+    (options, args) = parser.parse_args(argv)
+
+    commands = { 'user'   : manage_user,
+                 'group'  : manage_group,
+                 'machine': manage_machine }
+
+    if options.file == '-':
+        f = sys.stdin
+    else:
+        f = open(options.file)
+
+    # all lines share one connection
+    setAccount(getAccount())
+    ok = failed = 0
+
+    try:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            status = runBatchLine(commands, argv[0], line)
+            if status:
+                print 'line %d: failed (%s)' % (number, status)
+                failed += 1
+                if not options.keepGoing:
+                    break
+            else:
+                print 'line %d: ok' % number
+                ok += 1
+    finally:
+        setAccount(None)
+        if f is not sys.stdin:
+            f.close()
+
+    print '%d lines ok, %d failed' % (ok, failed)
+    if failed:
+        sys.exit(1)
+
+def runBatchLine(commands, program, line):
+    '''Run one line of a batch, returns 0 or what went wrong. A line fails
+       if its command exits with an error or raises one, or an operation it
+       ran reported a failure. LDAP errors handled as success, e.g. adding
+       an existing member, do not count.'''
+    try:
+        args = shlex.split(line)
+    except ValueError, e:
+        return str(e)
+
+    # lines copied from scripts may start with the program name
+    if args[0] == 'ldapsmb' or args[0].endswith('/ldapsmb'):
+        args = args[1:]
+    if not args or args[0].lower() not in commands:
+        return 'unknown command %s' % args[:1]
+
+    acc = getAccount()
+    del acc.failures[:]
+    try:
+        commands[args[0].lower()]([program] + args)
+    except SystemExit, e:
+        if e.code:
+            return 'exit status %s' % e.code
+    except (ldap.LDAPError, IdAllocationError), e:
+        print e
+        return e.__class__.__name__
+
+    if acc.failures:
+        return '%d operations failed' % len(acc.failures)
+    return 0
+
+def global_options(argv):
+    '''Split the options accepted by every command from argv:
+       --stats, --trace and --profile FILE (- prints the profile)'''
+    options = { 'stats': False, 'trace': False, 'profile': None }
+    rest    = []
+
+    args = iter(argv)
+    for arg in args:
+        if arg == '--stats':
+            options['stats'] = True
+        elif arg == '--trace':
+            options['trace'] = True
+        elif arg == '--profile':
+            options['profile'] = next(args, '-')
+        elif arg.startswith('--profile='):
+            options['profile'] = arg.split('=', 1)[1]
+        else:
+            rest.append(arg)
+
+    return rest, options
+
+def run_command(command, argv):
+    '''Run command(argv) with the global options applied. --trace logs
+       every LDAP operation and --stats prints a summary on stderr,
+       --profile runs the command under cProfile.'''
+    argv, options = global_options(argv)
+
+    if options['trace']:
+        stats.trace = sys.stderr
+
+    try:
+        if options['profile']:
+            import cProfile
+            import pstats
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(command, argv)
+            finally:
+                if options['profile'] == '-':
+                    p = pstats.Stats(profile, stream=sys.stderr)
+                    p.sort_stats('cumulative').print_stats(30)
+                else:
+                    profile.dump_stats(options['profile'])
+        else:
+            command(argv)
+    finally:
+        if options['stats']:
+            stats.summary(sys.stderr)
 
 def usage(argv):
     cmd = argv[0]
-    print 'Usage: ' + cmd + ' [populate | user | group | machine]'
+    print 'Usage: ' + cmd + ' [populate | user | group | machine | batch | export | import | audit | daemon] [--stats] [--trace] [--profile FILE]'
     exit(1)
 
 def main():
@@ -1233,17 +3918,31 @@ def main():
     if len(args) < 2:
         usage(args)
 
+    from ldapAccount import daemon, backup, audit
+
     command  = args[1]
     commands = { 'populate': do_population,
                  'user'    : manage_user,
                  'group'   : manage_group,
-                 'machine' : manage_machine }
+                 'machine' : manage_machine,
+                 'batch'   : do_batch,
+                 'export'  : backup.run_export,
+                 'import'  : backup.run_import,
+                 'audit'   : audit.run_audit,
+                 'daemon'  : daemon.run_daemon }
+
+    # hand the command to a running ldapsmb daemon, if there is one
+    status = daemon.forward(args)
+    if status is not None:
+        sys.exit(status)
 
     try:
-        commands[command.lower()](args)
+        command = commands[command.lower()]
     except KeyError, e:
         print 'Unknown action: ', e
         usage(args)
 
+    run_command(command, args)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,248 @@
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: consistency audit of the Samba part of the directory
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## ldapsmb audit reads the user, machine and group subtrees once with paged
+## searches and reports duplicate uidNumbers and gidNumbers, colliding
+## sambaSIDs, memberUid values without an account and next free counters on
+## the sambaDomain entry that are not above the highest ID in use. IDs are
+## kept in bitmaps and account names as 32 bit hashes, so memory stays a few
+## bytes per entry. Only the entries involved in a problem are read again to
+## report them by dn.
+
+import sys
+import array
+import bisect
+import heapq
+import zlib
+import optparse
+import ldap
+import ldapAccount
+
+FILTER     = '(|(objectClass=posixAccount)(objectClass=posixGroup)' \
+             '(objectClass=sambaSamAccount)(objectClass=sambaGroupMapping))'
+ATTRIBUTES = ['objectClass', 'uid', 'cn', 'uidNumber', 'gidNumber',
+              'sambaSID', 'memberUid']
+# domain counter attribute -> attribute of the IDs handed out from it
+COUNTERS   = (('uidNumber', 'uidNumber'), ('gidNumber', 'gidNumber'),
+              ('sambaNextRid', 'RID'))
+
+# name hashes are sorted in chunks of this size, then merged
+CHUNK      = 65536
+
+def nameHash(name):
+    return zlib.crc32(name.lower()) & 0xffffffff
+
+class Audit(object):
+    '''One pass over the accounts and groups collecting ID usage'''
+    def __init__(self, account, pageSize=None):
+        self.acc       = account
+        self.pageSize  = pageSize
+        self.domainSID = account.getDomainSID()
+        self.entries   = 0
+        self.problems  = 0
+
+        # IDs seen and IDs seen more than once
+        self.ids  = { 'uidNumber': ldapAccount.IdBitmap(),
+                      'gidNumber': ldapAccount.IdBitmap(),
+                      'RID'      : ldapAccount.IdBitmap() }
+        self.dups = { 'uidNumber': ldapAccount.IdBitmap(),
+                      'gidNumber': ldapAccount.IdBitmap(),
+                      'RID'      : ldapAccount.IdBitmap() }
+        # SIDs outside the domain, e.g. the builtin groups: only a few
+        self.sids      = set()
+        self.sidDups   = set()
+        self.invalid   = []  # (dn, attribute, value)
+
+        # hashes of the account names, sorted once the accounts are read
+        self.names     = array.array('L')
+        self.chunks    = []  # sorted chunks of names
+        self.sorted    = False
+        # accounts found after sorting, only with unusual suffixes
+        self.late      = set()
+        # (group, memberUid) not found among the accounts (yet)
+        self.missing   = []
+        # bases with groups read before the names were sorted
+        self.recheck   = []
+        self.basedn    = None
+
+    def bases(self):
+        '''The accounts come first, so members can be checked as the groups
+           arrive. Suffixes inside another one are searched only once.'''
+        bases = []
+        for basedn in (self.acc.userBase(), self.acc.machineBase(),
+                       self.acc.groupBase()):
+            key = basedn.lower()
+            if [b for b in bases if key == b or key.endswith(',' + b)]:
+                continue
+            bases = [b for b in bases if not b.endswith(',' + key)] + [key]
+        return bases
+
+    def run(self):
+        for basedn in self.bases():
+            if basedn == self.acc.groupBase().lower():
+                self.sortNames()
+            self.search(basedn, FILTER, ATTRIBUTES, self.entry)
+        self.sortNames()
+
+        # their members can be checked now, read them again
+        for basedn in self.recheck:
+            self.search(basedn, '(objectClass=posixGroup)', ['cn', 'memberUid'],
+                        self.members)
+
+    def search(self, basedn, filter, attributes, handler):
+        self.basedn = basedn
+        try:
+            for dn, attrs in self.acc.ldap_search_iter(basedn, filter,
+                                                       attributes,
+                                                       pageSize=self.pageSize):
+                handler(dn, attrs)
+        except ldap.NO_SUCH_OBJECT, e:
+            print basedn + ': No such object!'
+
+    def addName(self, name):
+        self.names.append(nameHash(name))
+        if len(self.names) >= CHUNK:
+            self.sortChunk()
+
+    def sortChunk(self):
+        if self.names:
+            self.chunks.append(array.array('L', sorted(self.names)))
+            self.names = array.array('L')
+
+    def sortNames(self):
+        '''Merge the sorted chunks, only one chunk is ever a list'''
+        if not self.sorted:
+            self.sortChunk()
+            self.names = array.array('L')
+            self.names.extend(heapq.merge(*self.chunks))
+            self.chunks = []
+            self.sorted = True
+
+    def entry(self, dn, attrs):
+        self.entries += 1
+        classes = [c.lower() for c in attrs.get('objectClass', [])]
+
+        if 'posixaccount' in classes:
+            self.number(dn, 'uidNumber', attrs)
+            for name in attrs.get('uid', []):
+                if self.sorted:
+                    self.late.add(name.lower())
+                else:
+                    self.addName(name)
+
+        if 'posixgroup' in classes:
+            self.number(dn, 'gidNumber', attrs)
+            if self.sorted:
+                self.members(dn, attrs)
+            elif self.basedn not in self.recheck:
+                self.recheck.append(self.basedn)
+
+        for sid in attrs.get('sambaSID', []):
+            self.sid(dn, sid)
+
+    def number(self, dn, attribute, attrs):
+        for value in attrs.get(attribute, []):
+            try:
+                id = int(value)
+                if id < 0:
+                    raise ValueError(value)
+            except ValueError, e:
+                self.invalid.append((dn, attribute, value))
+                continue
+            if not self.ids[attribute].add(id):
+                self.dups[attribute].add(id)
+
+    def sid(self, dn, sid):
+        domain, sep, rid = sid.rpartition('-')
+        if domain == self.domainSID and rid.isdigit():
+            if not self.ids['RID'].add(int(rid)):
+                self.dups['RID'].add(int(rid))
+        elif sid in self.sids:
+            self.sidDups.add(sid)
+        else:
+            self.sids.add(sid)
+
+    def members(self, dn, attrs):
+        '''Note the memberUids of a group not among the accounts (yet)'''
+        group = attrs.get('cn', [dn])[0]
+        for member in attrs.get('memberUid', []):
+            if not self.known(member):
+                self.missing.append((group, member))
+
+    def known(self, name):
+        if name.lower() in self.late:
+            return True
+        h = nameHash(name)
+        i = bisect.bisect_left(self.names, h)
+        return i < len(self.names) and self.names[i] == h
+
+    def owners(self, attribute, values, objectClass=None):
+        '''Return {value: [dn, ...]} of the entries having one of values'''
+        owners = {}
+        for basedn in self.bases():
+            filters = self.acc.orFilters(attribute, values, objectClass)
+            for dn, attrs in self.acc.ldap_search_many(basedn, filters,
+                                                       [attribute],
+                                                       window=self.acc.resolveWindow):
+                for value in attrs.get(attribute, []):
+                    owners.setdefault(value, []).append(dn)
+        return owners
+
+    def problem(self, message):
+        self.problems += 1
+        print message
+
+    def report(self):
+        '''Print the problems found, returns their number'''
+        for dn, attribute, value in self.invalid:
+            self.problem('%s: invalid %s %s' % (dn, attribute, value))
+
+        for attribute, objectClass in (('uidNumber', 'posixAccount'),
+                                       ('gidNumber', 'posixGroup')):
+            dups = [str(id) for id in self.dups[attribute]]
+            if dups:
+                owners = self.owners(attribute, dups, objectClass)
+                for id in dups:
+                    self.problem('%s %s used by %s' % (attribute, id,
+                                 ', '.join(owners.get(id, ['?']))))
+
+        sids = ['%s-%d' % (self.domainSID, rid) for rid in self.dups['RID']]
+        sids.extend(sorted(self.sidDups))
+        if sids:
+            owners = self.owners('sambaSID', sids)
+            for sid in sids:
+                self.problem('sambaSID %s used by %s' % (sid,
+                             ', '.join(owners.get(sid, ['?']))))
+
+        for group, member in self.missing:
+            if not self.known(member):
+                self.problem('%s: memberUid %s has no account' % (group, member))
+
+        dn     = self.acc.domainDN()
+        domain = self.acc.getDomain(refresh=True)
+        for counter, attribute in COUNTERS:
+            highest = self.ids[attribute].max()
+            if counter not in domain or highest is None:
+                continue
+            if int(domain[counter][0]) <= highest:
+                self.problem('%s: %s %s is not above the highest %s %d' % (
+                             dn, counter, domain[counter][0], attribute, highest))
+
+        return self.problems
+
+def run_audit(argv):
+    usage = '%prog audit [-h | --help] [Options]\n\n' \
+            'Exits with status 1 if problems were found.'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--page-size", dest='pageSize', help='entries per paged search result (default: [ldap] page size)', type='int')
+    (options, args) = parser.parse_args(argv)
+
+    audit = Audit(ldapAccount.getAccount(), options.pageSize)
+    audit.run()
+    problems = audit.report()
+
+    print '%d entries audited, %d problems found' % (audit.entries, problems)
+    if problems:
+        sys.exit(1)
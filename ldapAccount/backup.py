@@ -0,0 +1,253 @@
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: streaming export and restore of the Samba part of the directory
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## ldapsmb export writes the sambaDomain entry and the user, group and
+## machine subtrees as LDIF or JSON lines, optionally gzip or zstd
+## compressed. Entries are read with paged searches and written as they
+## arrive, so memory use does not grow with the directory. ldapsmb import
+## adds them again through the asynchronous pipeline.
+
+import os
+import re
+import sys
+import json
+import gzip
+import base64
+import optparse
+import subprocess
+import ldap
+import ldap.modlist
+import ldif
+import ldapAccount
+
+FORMATS      = ('ldif', 'json')
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+def guessFormat(filename, fileFormat=None, compression=None):
+    '''Fill in format and compression from the file name: .ldif or .json
+       (.jsonl), optionally followed by .gz or .zst'''
+    name = filename.lower()
+
+    for suffix, method in (('.gz', 'gzip'), ('.zst', 'zstd')):
+        if name.endswith(suffix):
+            name        = name[:-len(suffix)]
+            compression = compression or method
+    compression = compression or 'none'
+
+    if not fileFormat:
+        if name.endswith('.json') or name.endswith('.jsonl'):
+            fileFormat = 'json'
+        else:
+            fileFormat = 'ldif'
+
+    return fileFormat, compression
+
+def createFile(filename):
+    '''Open filename for writing, readable by its owner only: exports
+       contain password hashes'''
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    # the mode only applies to new files
+    os.fchmod(fd, 0600)
+    return os.fdopen(fd, 'wb')
+
+class ZstdFile(object):
+    '''Stream compressed or decompressed by the zstd command'''
+    def __init__(self, filename, mode='r'):
+        if mode == 'w':
+            self.file    = filename == '-' and sys.stdout or createFile(filename)
+            self.process = subprocess.Popen(['zstd', '-q', '-c'],
+                                            stdin=subprocess.PIPE,
+                                            stdout=self.file)
+            self.stream  = self.process.stdin
+        else:
+            self.file    = filename == '-' and sys.stdin or open(filename, 'rb')
+            self.process = subprocess.Popen(['zstd', '-q', '-d', '-c'],
+                                            stdin=self.file,
+                                            stdout=subprocess.PIPE)
+            self.stream  = self.process.stdout
+
+    def __iter__(self):
+        return iter(self.stream.readline, '')
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def close(self):
+        self.stream.close()
+        status = self.process.wait()
+        if self.file not in (sys.stdin, sys.stdout):
+            self.file.close()
+        if status:
+            raise IOError('zstd exited with status %d' % status)
+
+def openFile(filename, mode, compression):
+    '''Open filename (- for stdin/stdout) for reading (r) or writing (w)'''
+    if compression == 'gzip':
+        if filename == '-':
+            return gzip.GzipFile(mode=mode + 'b',
+                                 fileobj=mode == 'w' and sys.stdout or sys.stdin)
+        if mode == 'w':
+            f = gzip.GzipFile(filename, 'wb', fileobj=createFile(filename))
+            # closed with the GzipFile, as if it had opened it
+            f.myfileobj = f.fileobj
+            return f
+        return gzip.GzipFile(filename, 'rb')
+    if compression == 'zstd':
+        return ZstdFile(filename, mode)
+    if filename == '-':
+        return mode == 'w' and sys.stdout or sys.stdin
+    if mode == 'w':
+        return createFile(filename)
+    return open(filename, 'rb')
+
+def closeFile(f):
+    if f not in (sys.stdin, sys.stdout):
+        f.close()
+    else:
+        f.flush()
+
+def export(acc, out, fileFormat='ldif'):
+    '''Write the sambaDomain entry and the user, group and machine subtrees
+       to out, returns the number of entries written'''
+    writer = fileFormat == 'ldif' and ldif.LDIFWriter(out) or None
+    count  = 0
+    bases  = []
+
+    for basedn in (acc.domainDN(), acc.userBase(), acc.groupBase(),
+                   acc.machineBase()):
+        # the containers may be configured to be the same
+        if basedn.lower() in bases:
+            continue
+        bases.append(basedn.lower())
+
+        try:
+            for dn, attrs in acc.ldap_search_iter(basedn, '(objectClass=*)',
+                                                  None):
+                if writer:
+                    writer.unparse(dn, attrs)
+                else:
+                    out.write(json.dumps(acc.jsonEntry(dn, attrs)) + '\n')
+                count += 1
+        except ldap.NO_SUCH_OBJECT, e:
+            print >>sys.stderr, basedn + ': No such object!'
+
+    return count
+
+class Restore(object):
+    '''Add exported entries again, keeping a window of asynchronous adds
+       outstanding'''
+    def __init__(self, account, window=64):
+        self.pipeline = account.ldap_pipeline(window, self.added)
+        self.existed  = 0
+
+    def add(self, dn, entry):
+        # the server may answer out of order, an entry must not overtake
+        # the add of its parent
+        parent = re.split(r'(?<!\\),', dn, 1)[1:]
+        if parent:
+            self.pipeline.wait(parent[0])
+        self.pipeline.add(dn, ldap.modlist.addModlist(entry))
+
+    def added(self, dn, tag, error):
+        if error is None:
+            return
+        if isinstance(error, ldap.ALREADY_EXISTS):
+            print dn + ': Already exists'
+            self.existed += 1
+        elif isinstance(error, ldap.NO_SUCH_OBJECT):
+            print dn + ': No such object!'
+        else:
+            print dn + ':', error.args
+
+    def readLDIF(self, f):
+        _LDIFReader(f, self).parse()
+
+    def readJSON(self, f):
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            dn    = entry.pop('dn').encode('utf-8')
+            attrs = {}
+            for attribute, values in entry.iteritems():
+                attribute = attribute.encode('utf-8')
+                if attribute.endswith(';base64'):
+                    attrs[attribute[:-7]] = [base64.b64decode(v) for v in values]
+                else:
+                    attrs[attribute] = [v.encode('utf-8') for v in values]
+            self.add(dn, attrs)
+
+    def finish(self):
+        self.pipeline.flush()
+
+    def counts(self):
+        '''Return the number of restored, existing and failed entries'''
+        errors = self.pipeline.errors
+        return (self.pipeline.done - errors, self.existed,
+                errors - self.existed)
+
+class _LDIFReader(ldif.LDIFParser):
+    def __init__(self, f, restore):
+        ldif.LDIFParser.__init__(self, f)
+        self.restore = restore
+
+    def handle(self, dn, entry):
+        self.restore.add(dn, entry)
+
+def fileOptions(usage):
+    parser = optparse.OptionParser(usage)
+    parser.add_option("-f", "--file", dest='file', help='file name, - for stdin/stdout (default: -)', default='-')
+    parser.add_option("--format", dest='fileFormat', help='ldif or json (default: by extension, else ldif)', choices=FORMATS)
+    parser.add_option("-z", "--compress", dest='compression', help='gzip, zstd or none (default: by extension, else none)', choices=COMPRESSIONS)
+    return parser
+
+def run_export(argv):
+    parser = fileOptions('%prog export [-h | --help] [Options]')
+    (options, args) = parser.parse_args(argv)
+
+    fileFormat, compression = guessFormat(options.file, options.fileFormat,
+                                          options.compression)
+    acc = ldapAccount.getAccount()
+
+    try:
+        out = openFile(options.file, 'w', compression)
+        try:
+            count = export(acc, out, fileFormat)
+        finally:
+            closeFile(out)
+    except (IOError, OSError), e:
+        sys.exit('%s: %s' % (options.file, e))
+
+    # keep stdout clean for the export itself
+    log = options.file == '-' and sys.stderr or sys.stdout
+    print >>log, '%d entries exported' % count
+
+def run_import(argv):
+    parser = fileOptions('%prog import [-h | --help] [Options]')
+    parser.add_option("--window", dest='window', help='number of adds kept outstanding (default: 64)', type='int', default=64)
+    (options, args) = parser.parse_args(argv)
+
+    fileFormat, compression = guessFormat(options.file, options.fileFormat,
+                                          options.compression)
+    restore = Restore(ldapAccount.getAccount(), options.window)
+
+    try:
+        f = openFile(options.file, 'r', compression)
+        try:
+            if fileFormat == 'json':
+                restore.readJSON(f)
+            else:
+                restore.readLDIF(f)
+            restore.finish()
+        finally:
+            closeFile(f)
+    except (IOError, OSError), e:
+        sys.exit('%s: %s' % (options.file, e))
+
+    restored, existed, failed = restore.counts()
+    print '%d entries restored, %d existed, %d failed' % (restored, existed,
+                                                          failed)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,287 @@
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: ldapsmb daemon keeping bound LDAP connections between commands
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## The daemon listens on a Unix socket. Every request is one JSON line
+## {"argv": [...]} and is answered with one JSON line {"output": ...,
+## "status": ...} after the command ran on a pooled, already bound Account.
+## {"metrics": true} is answered with the LDAP operation counters in the
+## Prometheus text format as output.
+
+import os
+import sys
+import json
+import socket
+import optparse
+import threading
+import traceback
+import Queue
+import SocketServer
+import StringIO
+import ldap
+import ldapAccount
+
+# commands the front-end forwards to a running daemon
+FORWARDED = ('user', 'group', 'machine')
+# options prompting on the terminal, reading local files, streaming large
+# output or reporting on this process, commands using them always run
+# directly
+LOCAL_OPTIONS = ('-', '-W', '--askPassword', '-i', '--import', '-l', '--list',
+                 '--delete-from', '--set-members', '--passwords-from',
+                 '--ldif', '--stats', '--trace', '--profile')
+
+def socketPath(cfg):
+    return cfg.getOp('daemon', 'socket') or '/var/run/ldapsmb.sock'
+
+class ConnectionPool(object):
+    '''Pool of bound Account sessions, created on first use'''
+    def __init__(self, configFile, size=4):
+        self.configFile = configFile
+        self.size       = size
+        self.created    = 0
+        self.idle       = Queue.Queue()
+        self.lock       = threading.Lock()
+        self.cache      = None
+        self.idMap      = None
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if not create:
+            return self.idle.get()
+
+        try:
+            # all sessions share one lookup cache, so writes through any of
+            # them invalidate it, and one map of used IDs
+            acc = ldapAccount.Account(self.configFile, self.cache)
+            self.cache = acc.cache
+            with self.lock:
+                if self.idMap is None:
+                    self.idMap = acc.idMap
+                acc.idMap = self.idMap
+            return acc
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, acc):
+        self.idle.put(acc)
+
+    def discard(self, acc):
+        '''Drop a broken session, the next acquire connects a new one'''
+        with self.lock:
+            self.created -= 1
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    '''Run one forwarded command on a pooled Account'''
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            request = json.loads(line)
+            if request.get('metrics'):
+                self.reply(ldapAccount.stats.prometheus(), 0)
+                return
+            argv = request['argv']
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            self.reply('Invalid request\n', 1)
+            return
+
+        output = StringIO.StringIO()
+        status = self.server.run(argv, output)
+        self.reply(output.getvalue(), status)
+
+    def reply(self, output, status):
+        self.wfile.write(json.dumps({'output': output, 'status': status}) + '\n')
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''Unix socket server executing ldapsmb commands over pooled
+       connections'''
+    daemon_threads = True
+
+    def __init__(self, configFile, path, poolSize=4):
+        self.pool = ConnectionPool(configFile, poolSize)
+        self.path = path
+        self.commands = { 'user'   : ldapAccount.manage_user,
+                          'group'  : ldapAccount.manage_group,
+                          'machine': ldapAccount.manage_machine }
+
+        if os.path.exists(path):
+            s = _connect(path)
+            if s:
+                s.close()
+                raise socket.error('%s: ldapsmb daemon already running' % path)
+            os.unlink(path)
+
+        # only the owner (who can read the bind password anyway) may connect
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+        sys.stdout = ldapAccount.ThreadOutput(sys.stdout)
+        sys.stderr = ldapAccount.ThreadOutput(sys.stderr)
+
+    def run(self, argv, output):
+        if len(argv) < 2 or argv[1].lower() not in self.commands:
+            output.write('Unknown action: %s\n' % argv[1:2])
+            return 1
+
+        sys.stdout.capture(output)
+        sys.stderr.capture(output)
+        status = 0
+
+        acc = self.pool.acquire()
+        try:
+            # failures are noted per request
+            del acc.failures[:]
+            ldapAccount.setAccount(acc)
+            self.commands[argv[1].lower()](argv)
+        except SystemExit, e:
+            status = e.code
+        except ldap.SERVER_DOWN, e:
+            # reconnect on the next request instead of reusing this session
+            print 'LDAP server unavailable:', e.args
+            self.pool.discard(acc)
+            acc    = None
+            status = 1
+        except Exception, e:
+            traceback.print_exc()
+            status = 1
+        finally:
+            ldapAccount.setAccount(None)
+            sys.stdout.capture(None)
+            sys.stderr.capture(None)
+            if acc is not None:
+                # most methods print LDAP errors instead of raising them,
+                # a lost connection shows up among the failures
+                if [f for f in acc.failures
+                    if isinstance(f[1], ldap.SERVER_DOWN)]:
+                    self.pool.discard(acc)
+                else:
+                    self.pool.release(acc)
+
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            output.write('%s\n' % status)
+            status = 1
+
+        return status
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def _connect(path):
+    '''Connect to the daemon socket, None if no daemon is listening'''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return s
+    except socket.error, e:
+        s.close()
+        return None
+
+def runsLocally(argv):
+    for arg in argv[2:]:
+        if arg.startswith('--'):
+            if arg.split('=', 1)[0] in LOCAL_OPTIONS:
+                return True
+        elif arg.startswith('-'):
+            # short options may be combined: -SW
+            if arg == '-' or [c for c in arg[1:] if '-' + c in LOCAL_OPTIONS]:
+                return True
+    return False
+
+def forward(argv, configFile=None):
+    '''Run a command on the running daemon. Returns the exit status, or
+       None if the command has to run directly'''
+    if len(argv) < 2 or argv[1].lower() not in FORWARDED:
+        return None
+    if runsLocally(argv):
+        return None
+
+    path = socketPath(ldapAccount.Config(configFile or ldapAccount.cfgfile))
+    if not os.path.exists(path):
+        return None
+
+    s = _connect(path)
+    if not s:
+        return None
+
+    # the command may have run already, never fall back from here on
+    return request(s, path, {'argv': argv})
+
+def request(s, path, message):
+    '''Send one request to the daemon and print its output'''
+    try:
+        s.sendall(json.dumps(message) + '\n')
+        reply = json.loads(s.makefile('r').readline())
+    except (socket.error, ValueError), e:
+        print 'ldapsmb daemon at %s: no valid reply' % path
+        return 1
+    finally:
+        s.close()
+
+    sys.stdout.write(reply['output'])
+    return reply['status']
+
+def _detach():
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir('/')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+def run_daemon(argv):
+    usage = '%prog daemon [-h | --help] [Options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("-s", "--socket", dest='socket', help='Unix socket to listen on (default: [daemon] socket or /var/run/ldapsmb.sock)')
+    parser.add_option("-p", "--pool", dest='pool', help='number of pooled LDAP connections (default: [daemon] pool size or 4)', type='int')
+    parser.add_option("-D", "--detach", dest='detach', help='run in the background', action='store_true')
+    parser.add_option("--metrics", dest='metrics', help='print the LDAP operation counters of the running daemon in Prometheus text format', action='store_true')
+
+    (options, args) = parser.parse_args(argv)
+
+    cfg  = ldapAccount.Config(ldapAccount.cfgfile)
+    path = options.socket or socketPath(cfg)
+    size = options.pool or int(cfg.getOp('daemon', 'pool size') or 4)
+
+    if options.metrics:
+        s = _connect(path)
+        if not s:
+            parser.error('no ldapsmb daemon listening on %s' % path)
+        sys.exit(request(s, path, {'metrics': True}))
+
+    server = Daemon(ldapAccount.cfgfile, path, size)
+    # connect one session up front, so configuration errors show at start
+    server.pool.release(server.pool.acquire())
+
+    if options.detach:
+        _detach()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
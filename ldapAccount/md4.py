@@ -0,0 +1,88 @@
+## vim: set ts=2 sw=2 noai noet
+##
+## purpose: pure python MD4 (RFC 1320) for NT password hashes
+## license: GPLv3+, http://www.gnu.org/licenses/gpl-3.0.html
+##
+## hashlib only offers MD4 if OpenSSL does, OpenSSL 3 needs the legacy
+## provider for it. The rounds are unrolled and work on local variables,
+## which makes this several times faster than a loop over the RFC tables.
+
+import struct
+
+MASK = 0xffffffff
+
+_words  = struct.Struct('<16I').unpack
+_state  = struct.Struct('<4I').pack
+_length = struct.Struct('<Q').pack
+
+def digest(data):
+    '''Return the MD4 digest of the string data'''
+    length = len(data)
+    data  += '\x80' + '\x00' * ((55 - length) % 64) + _length(length * 8)
+
+    a, b, c, d = 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476
+
+    for offset in xrange(0, len(data), 64):
+        x = _words(data[offset:offset + 64])
+        aa, bb, cc, dd = a, b, c, d
+
+        # round 1
+        a = (a + ((b & c) | (~b & d)) + x[0]) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (~a & c)) + x[1]) & MASK; d = (d << 7 | d >> 25) & MASK
+        c = (c + ((d & a) | (~d & b)) + x[2]) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + ((c & d) | (~c & a)) + x[3]) & MASK; b = (b << 19 | b >> 13) & MASK
+        a = (a + ((b & c) | (~b & d)) + x[4]) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (~a & c)) + x[5]) & MASK; d = (d << 7 | d >> 25) & MASK
+        c = (c + ((d & a) | (~d & b)) + x[6]) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + ((c & d) | (~c & a)) + x[7]) & MASK; b = (b << 19 | b >> 13) & MASK
+        a = (a + ((b & c) | (~b & d)) + x[8]) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (~a & c)) + x[9]) & MASK; d = (d << 7 | d >> 25) & MASK
+        c = (c + ((d & a) | (~d & b)) + x[10]) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + ((c & d) | (~c & a)) + x[11]) & MASK; b = (b << 19 | b >> 13) & MASK
+        a = (a + ((b & c) | (~b & d)) + x[12]) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (~a & c)) + x[13]) & MASK; d = (d << 7 | d >> 25) & MASK
+        c = (c + ((d & a) | (~d & b)) + x[14]) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + ((c & d) | (~c & a)) + x[15]) & MASK; b = (b << 19 | b >> 13) & MASK
+
+        # round 2
+        a = (a + ((b & c) | (b & d) | (c & d)) + x[0] + 0x5a827999) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (a & c) | (b & c)) + x[4] + 0x5a827999) & MASK; d = (d << 5 | d >> 27) & MASK
+        c = (c + ((d & a) | (d & b) | (a & b)) + x[8] + 0x5a827999) & MASK; c = (c << 9 | c >> 23) & MASK
+        b = (b + ((c & d) | (c & a) | (d & a)) + x[12] + 0x5a827999) & MASK; b = (b << 13 | b >> 19) & MASK
+        a = (a + ((b & c) | (b & d) | (c & d)) + x[1] + 0x5a827999) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (a & c) | (b & c)) + x[5] + 0x5a827999) & MASK; d = (d << 5 | d >> 27) & MASK
+        c = (c + ((d & a) | (d & b) | (a & b)) + x[9] + 0x5a827999) & MASK; c = (c << 9 | c >> 23) & MASK
+        b = (b + ((c & d) | (c & a) | (d & a)) + x[13] + 0x5a827999) & MASK; b = (b << 13 | b >> 19) & MASK
+        a = (a + ((b & c) | (b & d) | (c & d)) + x[2] + 0x5a827999) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (a & c) | (b & c)) + x[6] + 0x5a827999) & MASK; d = (d << 5 | d >> 27) & MASK
+        c = (c + ((d & a) | (d & b) | (a & b)) + x[10] + 0x5a827999) & MASK; c = (c << 9 | c >> 23) & MASK
+        b = (b + ((c & d) | (c & a) | (d & a)) + x[14] + 0x5a827999) & MASK; b = (b << 13 | b >> 19) & MASK
+        a = (a + ((b & c) | (b & d) | (c & d)) + x[3] + 0x5a827999) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + ((a & b) | (a & c) | (b & c)) + x[7] + 0x5a827999) & MASK; d = (d << 5 | d >> 27) & MASK
+        c = (c + ((d & a) | (d & b) | (a & b)) + x[11] + 0x5a827999) & MASK; c = (c << 9 | c >> 23) & MASK
+        b = (b + ((c & d) | (c & a) | (d & a)) + x[15] + 0x5a827999) & MASK; b = (b << 13 | b >> 19) & MASK
+
+        # round 3
+        a = (a + (b ^ c ^ d) + x[0] + 0x6ed9eba1) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + (a ^ b ^ c) + x[8] + 0x6ed9eba1) & MASK; d = (d << 9 | d >> 23) & MASK
+        c = (c + (d ^ a ^ b) + x[4] + 0x6ed9eba1) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + (c ^ d ^ a) + x[12] + 0x6ed9eba1) & MASK; b = (b << 15 | b >> 17) & MASK
+        a = (a + (b ^ c ^ d) + x[2] + 0x6ed9eba1) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + (a ^ b ^ c) + x[10] + 0x6ed9eba1) & MASK; d = (d << 9 | d >> 23) & MASK
+        c = (c + (d ^ a ^ b) + x[6] + 0x6ed9eba1) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + (c ^ d ^ a) + x[14] + 0x6ed9eba1) & MASK; b = (b << 15 | b >> 17) & MASK
+        a = (a + (b ^ c ^ d) + x[1] + 0x6ed9eba1) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + (a ^ b ^ c) + x[9] + 0x6ed9eba1) & MASK; d = (d << 9 | d >> 23) & MASK
+        c = (c + (d ^ a ^ b) + x[5] + 0x6ed9eba1) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + (c ^ d ^ a) + x[13] + 0x6ed9eba1) & MASK; b = (b << 15 | b >> 17) & MASK
+        a = (a + (b ^ c ^ d) + x[3] + 0x6ed9eba1) & MASK; a = (a << 3 | a >> 29) & MASK
+        d = (d + (a ^ b ^ c) + x[11] + 0x6ed9eba1) & MASK; d = (d << 9 | d >> 23) & MASK
+        c = (c + (d ^ a ^ b) + x[7] + 0x6ed9eba1) & MASK; c = (c << 11 | c >> 21) & MASK
+        b = (b + (c ^ d ^ a) + x[15] + 0x6ed9eba1) & MASK; b = (b << 15 | b >> 17) & MASK
+
+        a = (a + aa) & MASK
+        b = (b + bb) & MASK
+        c = (c + cc) & MASK
+        d = (d + dd) & MASK
+
+    return _state(a, b, c, d)
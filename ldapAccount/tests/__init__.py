@@ -0,0 +1,3 @@
+# Unit tests of ldapAccount, they need python-ldap but no LDAP server:
+#
+#   python -m unittest discover -s ldapAccount/tests -t .
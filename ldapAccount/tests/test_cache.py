@@ -0,0 +1,140 @@
+'''LookupCache: expiry, least recently used eviction and the cache file'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import ldapAccount
+
+class Clock(object):
+    '''Replaces the time module of ldapAccount'''
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(1000000.0)
+        ldapAccount.time = self.clock
+
+    def tearDown(self):
+        ldapAccount.time = time
+
+    def testGet(self):
+        cache = ldapAccount.LookupCache()
+        self.assertEqual(cache.get(('uidNumber', 'alice')), None)
+        cache.set(('uidNumber', 'alice'), '1000')
+        self.assertEqual(cache.get(('uidNumber', 'alice')), '1000')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def testExpiry(self):
+        cache = ldapAccount.LookupCache(ttl=60)
+        cache.set(('uidNumber', 'alice'), '1000')
+        self.clock.now += 59
+        self.assertEqual(cache.get(('uidNumber', 'alice')), '1000')
+        self.clock.now += 2
+        self.assertEqual(cache.get(('uidNumber', 'alice')), None)
+        self.assertEqual(len(cache.entries), 0)
+
+    def testDisabled(self):
+        cache = ldapAccount.LookupCache(ttl=0)
+        cache.set(('uidNumber', 'alice'), '1000')
+        self.assertEqual(cache.get(('uidNumber', 'alice')), None)
+
+    def testNoneIsNotCached(self):
+        cache = ldapAccount.LookupCache()
+        cache.set(('uidNumber', 'alice'), None)
+        self.assertEqual(len(cache.entries), 0)
+
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = ldapAccount.LookupCache(size=2)
+        cache.set(('cn', 'a'), 'A')
+        cache.set(('cn', 'b'), 'B')
+        cache.get(('cn', 'a'))
+        cache.set(('cn', 'c'), 'C')
+        self.assertEqual(cache.get(('cn', 'b')), None)
+        self.assertEqual(cache.get(('cn', 'a')), 'A')
+        self.assertEqual(cache.get(('cn', 'c')), 'C')
+
+    def testSetRefreshes(self):
+        cache = ldapAccount.LookupCache(size=2, ttl=60)
+        cache.set(('cn', 'a'), 'A')
+        cache.set(('cn', 'b'), 'B')
+        self.clock.now += 50
+        cache.set(('cn', 'a'), 'A2')
+        cache.set(('cn', 'c'), 'C')
+        self.assertEqual(cache.get(('cn', 'b')), None)
+        self.clock.now += 50
+        self.assertEqual(cache.get(('cn', 'a')), 'A2')
+
+    def testDiscard(self):
+        cache = ldapAccount.LookupCache()
+        cache.set(('cn', '1000'), 'staff')
+        cache.set(('cn', '1001'), 'admins')
+        cache.set(('members', 'staff'), ['alice'])
+        cache.discard(('members', 'staff'), ('members', 'unknown'))
+        self.assertEqual(cache.get(('members', 'staff')), None)
+        cache.discardKind('cn')
+        self.assertEqual(len(cache.entries), 0)
+
+class CacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self, size=1024):
+        # without a filename, no save is registered to run at exit
+        cache = ldapAccount.LookupCache(size=size)
+        cache.filename = self.filename
+        return cache
+
+    def testSaveAndLoad(self):
+        cache = self.cache()
+        cache.set(('uidNumber', 'alice'), '1000')
+        cache.set(('members', 'staff'), ['alice', 'bob'])
+        cache.save()
+
+        copy = self.cache()
+        copy.load()
+        self.assertEqual(copy.get(('uidNumber', 'alice')), '1000')
+        self.assertEqual(copy.get(('members', 'staff')), ['alice', 'bob'])
+        self.assertTrue(isinstance(copy.get(('uidNumber', 'alice')), str))
+
+    def testLoadSkipsExpired(self):
+        cache = self.cache()
+        cache.set(('uidNumber', 'alice'), '1000')
+        cache.set(('uidNumber', 'bob'), '1001')
+        expires, value = cache.entries[('uidNumber', 'alice')]
+        cache.entries[('uidNumber', 'alice')] = (time.time() - 1, value)
+        cache.save()
+
+        copy = self.cache()
+        copy.load()
+        self.assertEqual(copy.entries.keys(), [('uidNumber', 'bob')])
+
+    def testLoadKeepsNewest(self):
+        cache = self.cache()
+        for name in ('a', 'b', 'c'):
+            cache.set(('cn', name), name.upper())
+        cache.save()
+
+        copy = self.cache(size=2)
+        copy.load()
+        self.assertEqual(copy.entries.keys(), [('cn', 'b'), ('cn', 'c')])
+
+    def testBrokenFile(self):
+        f = open(self.filename, 'w')
+        f.write('{not json')
+        f.close()
+        cache = self.cache()
+        cache.load()
+        self.assertEqual(len(cache.entries), 0)
+
+if __name__ == '__main__':
+    unittest.main()
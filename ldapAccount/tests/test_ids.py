@@ -0,0 +1,329 @@
+'''ID allocation: IdBitmap, the counter compare and swap, the local blocks
+and the claims of IdMap'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import ldap
+
+import ldapAccount
+
+SUFFIX   = 'dc=example,dc=org'
+DOMAIN   = 'sambaDomainName=TEST,' + SUFFIX
+USERS    = 'ou=users,' + SUFFIX
+CLAIMS   = 'cn=ldapsmb id claims,' + DOMAIN
+SID      = 'S-1-5-21-1-2-3'
+
+class Directory(object):
+    '''In-memory stand-in for the python-ldap session calls the allocator
+       makes, modifies are atomic like on a server'''
+    def __init__(self):
+        self.entries = {}  # lower case dn -> (dn, attributes)
+        self.modifies = 0
+
+    def put(self, dn, attrs):
+        self.entries[dn.lower()] = (dn, dict((a, list(v))
+                                             for a, v in attrs.items()))
+
+    def get(self, dn):
+        return self.entries[dn.lower()][1]
+
+    def add_s(self, dn, modlist):
+        if dn.lower() in self.entries:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        self.put(dn, dict(modlist))
+
+    def modify_s(self, dn, mods):
+        if dn.lower() not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        self.modifies += 1
+        attrs = dict((a, list(v)) for a, v in self.get(dn).items())
+
+        for op, attribute, values in mods:
+            current = attrs.setdefault(attribute, [])
+            if op == ldap.MOD_DELETE:
+                for value in values:
+                    if value not in current:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': 'No such attribute'})
+                    current.remove(value)
+            elif op == ldap.MOD_ADD:
+                for value in values:
+                    if value in current:
+                        raise ldap.TYPE_OR_VALUE_EXISTS({'desc': 'Type or value exists'})
+                    current.append(value)
+            else:
+                attrs[attribute] = list(values)
+            if not attrs[attribute]:
+                del attrs[attribute]
+
+        self.put(dn, attrs)
+
+    def search(self, basedn, scope):
+        if scope == ldap.SCOPE_BASE:
+            if basedn.lower() not in self.entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+            return [self.entries[basedn.lower()]]
+        return [e for key, e in sorted(self.entries.items())
+                if key.endswith(',' + basedn.lower())]
+
+class FakeAccount(ldapAccount.Account):
+    '''Account on a Directory, the filters of subtree searches are ignored'''
+    def __init__(self, directory, samba=None):
+        self.directory = directory
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'ldapsmb.conf')
+            f = open(filename, 'w')
+            f.write('[ldap]\nuri = ldap://localhost\nbinddn = cn=admin\n'
+                    'passwd = secret\nusetls = false\n')
+            f.write('[samba]\nldap suffix = %s\nldap user suffix = ou=users\n'
+                    'sambaDomain = TEST\nuid = 1000\n' % SUFFIX)
+            for option, value in (samba or {}).items():
+                f.write('%s = %s\n' % (option, value))
+            f.close()
+            ldapAccount.Account.__init__(self, filename,
+                                         ldapAccount.LookupCache(ttl=0))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def connect(self, uri, binddn, passwd, usetls):
+        return self.directory
+
+    def ldap_search_iter(self, basedn, filter, attributes,
+                         scope=ldap.SCOPE_SUBTREE, pageSize=None):
+        return iter(self.directory.search(basedn, scope))
+
+    def resolve(self, basedn, attribute, values, attributes, objectClass=None,
+                chunk=None):
+        wanted = set(str(v) for v in values)
+        found  = {}
+        for dn, attrs in self.directory.search(basedn, ldap.SCOPE_SUBTREE):
+            for value in attrs.get(attribute, []):
+                if value in wanted:
+                    found[value] = (dn, attrs)
+        return found
+
+def newDirectory(uidNumbers=(), nextUid=1010):
+    directory = Directory()
+    directory.put(DOMAIN, {'objectClass': ['sambaDomain'],
+                           'sambaDomainName': ['TEST'], 'sambaSID': [SID],
+                           'uidNumber': [str(nextUid)], 'gidNumber': ['1000'],
+                           'sambaNextRid': ['1000']})
+    for uid in uidNumbers:
+        directory.put('uid=u%d,%s' % (uid, USERS),
+                      {'objectClass': ['posixAccount'], 'uid': ['u%d' % uid],
+                       'uidNumber': [str(uid)]})
+    return directory
+
+class IdBitmapTest(unittest.TestCase):
+    def testAdd(self):
+        ids = ldapAccount.IdBitmap()
+        self.assertTrue(ids.add(5))
+        self.assertFalse(ids.add(5))
+        self.assertTrue(ids.add(70000))
+        self.assertEqual(len(ids), 2)
+        self.assertTrue(5 in ids)
+        self.assertFalse(6 in ids)
+        self.assertFalse(200000 in ids)
+        self.assertEqual(list(ids), [5, 70000])
+        self.assertEqual(ids.max(), 70000)
+        self.assertEqual(ldapAccount.IdBitmap().max(), None)
+
+    def testLowestFree(self):
+        ids = ldapAccount.IdBitmap()
+        for id in range(0, 21):
+            ids.add(id)
+        self.assertEqual(ids.lowestFree(), 21)
+        self.assertEqual(ids.lowestFree(5), 21)
+        self.assertEqual(ids.lowestFree(30), 30)
+
+    def testLowestFreeCrossesPages(self):
+        ids = ldapAccount.IdBitmap()
+        for id in range(ids.pageBits - 10, ids.pageBits + 3):
+            ids.add(id)
+        self.assertEqual(ids.lowestFree(ids.pageBits - 10), ids.pageBits + 3)
+
+    def testFreeRange(self):
+        ids = ldapAccount.IdBitmap()
+        for id in (3, 4, 8):
+            ids.add(id)
+        self.assertEqual(ids.freeRange(3), 0)
+        self.assertEqual(ids.freeRange(3, 3), 5)
+        self.assertEqual(ids.freeRange(4, 3), 9)
+        self.assertEqual(ids.nextUsed(5, 8), None)
+        self.assertEqual(ids.nextUsed(5, 9), 8)
+
+    def testPack(self):
+        ids = ldapAccount.IdBitmap()
+        for id in (1, 1000, 131072):
+            ids.add(id)
+        copy = ldapAccount.IdBitmap.unpack(ids.pack())
+        self.assertEqual(list(copy), [1, 1000, 131072])
+        self.assertEqual(len(copy), 3)
+
+class ReserveIdsTest(unittest.TestCase):
+    def testReserve(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory)
+        self.assertEqual(acc.reserveIds('uidNumber', 5), 1010)
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1015'])
+
+    def testStaleCounterIsRetried(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory)
+        acc.getDomain()
+        # another process advances the counter behind the cached value
+        other = FakeAccount(directory)
+        self.assertEqual(other.reserveIds('uidNumber', 3), 1010)
+
+        self.assertEqual(acc.reserveIds('uidNumber'), 1013)
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1014'])
+
+    def testMissingCounter(self):
+        directory = newDirectory()
+        del directory.get(DOMAIN)['gidNumber']
+        acc = FakeAccount(directory)
+        self.assertRaises(ldapAccount.IdAllocationError,
+                          acc.reserveIds, 'gidNumber')
+
+class AllocateIdTest(unittest.TestCase):
+    def testBlock(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory, {'id block size': 4})
+        self.assertEqual([acc.allocateId('uidNumber') for i in range(5)],
+                         ['1010', '1011', '1012', '1013', '1014'])
+        self.assertEqual(directory.modifies, 2)
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1018'])
+
+    def testExpiredBlockIsLeft(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory, {'id block size': 4,
+                                      'id block lifetime': 60})
+        self.assertEqual(acc.allocateId('uidNumber'), '1010')
+        acc.idPools['uidNumber'][2] -= 61
+        self.assertEqual(acc.allocateId('uidNumber'), '1014')
+
+    def testReleasePutsCounterBack(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory)
+        id = acc.allocateId('uidNumber')
+        acc.releaseIds([('uidNumber', id)])
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1010'])
+        self.assertEqual(acc.allocateId('uidNumber'), '1010')
+
+    def testReleaseAfterCounterMoved(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory)
+        id = acc.allocateId('uidNumber')
+        FakeAccount(directory).reserveIds('uidNumber')
+
+        acc.releaseIds([('uidNumber', id)])
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1012'])
+        # still reserved by acc, so it is handed out again
+        self.assertEqual(acc.allocateId('uidNumber'), '1010')
+
+    def testReleaseInBlock(self):
+        directory = newDirectory()
+        acc = FakeAccount(directory, {'id block size': 4})
+        first  = acc.allocateId('uidNumber')
+        second = acc.allocateId('uidNumber')
+        # only the last ID handed out can go back
+        acc.releaseIds([('uidNumber', first)])
+        acc.releaseIds([('uidNumber', second)])
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1014'])
+        self.assertEqual(acc.allocateId('uidNumber'), '1011')
+
+class IdMapTest(unittest.TestCase):
+    lowest = {'id allocation': 'lowest', 'id block lifetime': 300}
+
+    def claims(self, directory, counter='uidNumber'):
+        return sorted(v for v in directory.get(CLAIMS)['description']
+                      if v.startswith('claim %s ' % counter))
+
+    def marked(self, directory, mark=1010, age=1000):
+        directory.put(CLAIMS, {'objectClass': ['organizationalRole'],
+                               'cn': ['ldapsmb id claims'],
+                               'description': ['serial 3',
+                                   'mark uidNumber %d %d' % (mark,
+                                                  int(time.time()) - age)]})
+
+    def testFirstRunOnlyMarks(self):
+        directory = newDirectory([1000, 1001, 1003])
+        acc = FakeAccount(directory, self.lowest)
+        # nothing is known about blocks reserved before, the counter is used
+        self.assertEqual(acc.allocateIds('uidNumber'), 1010)
+        values = directory.get(CLAIMS)['description']
+        self.assertTrue('serial 1' in values)
+        self.assertEqual(len([v for v in values
+                              if v.startswith('mark uidNumber 1010 ')]), 1)
+
+    def testGapBelowOldMark(self):
+        directory = newDirectory([1000, 1001, 1003])
+        self.marked(directory)
+        acc = FakeAccount(directory, self.lowest)
+        self.assertEqual(acc.allocateIds('uidNumber'), 1002)
+        self.assertEqual(acc.allocateIds('uidNumber'), 1004)
+        self.assertEqual(directory.get(DOMAIN)['uidNumber'], ['1010'])
+        self.assertEqual(len(self.claims(directory)), 2)
+        self.assertTrue('serial 5' in directory.get(CLAIMS)['description'])
+
+    def testClaimsAreHeld(self):
+        directory = newDirectory([1000, 1001, 1003])
+        self.marked(directory)
+        first  = FakeAccount(directory, self.lowest)
+        second = FakeAccount(directory, self.lowest)
+        self.assertEqual(first.allocateIds('uidNumber'), 1002)
+        # the second map does not know about 1002, the claim keeps it off
+        self.assertEqual(second.allocateIds('uidNumber'), 1004)
+
+    def testExpiredClaimIsRemoved(self):
+        directory = newDirectory([1000, 1001, 1003])
+        self.marked(directory)
+        old = 'claim uidNumber 1002 1 %d' % (int(time.time()) - 1000)
+        directory.get(CLAIMS)['description'].append(old)
+        acc = FakeAccount(directory, self.lowest)
+        self.assertEqual(acc.allocateIds('uidNumber'), 1002)
+        self.assertFalse(old in directory.get(CLAIMS)['description'])
+
+    def testWatermark(self):
+        directory = newDirectory([1000, 1001, 1003])
+        # blocks reserved from 1002 on may still be handed out
+        self.marked(directory, mark=1002)
+        acc = FakeAccount(directory, self.lowest)
+        self.assertEqual(acc.allocateIds('uidNumber'), 1010)
+        self.assertEqual(self.claims(directory), [])
+
+    def testYoungMarkIsNoWatermark(self):
+        directory = newDirectory([1000, 1001, 1003])
+        self.marked(directory, age=10)
+        acc = FakeAccount(directory, self.lowest)
+        self.assertEqual(acc.allocateIds('uidNumber'), 1010)
+
+    def testTakenOnServer(self):
+        directory = newDirectory([1000, 1001, 1003])
+        self.marked(directory)
+        acc = FakeAccount(directory, self.lowest)
+        acc.idMap.refresh(acc)
+        # created by someone else after the map was read
+        directory.put('uid=late,' + USERS, {'objectClass': ['posixAccount'],
+                                            'uidNumber': ['1002']})
+        self.assertEqual(acc.allocateIds('uidNumber'), 1004)
+        self.assertTrue(1002 in acc.idMap.ids['uidNumber'])
+
+    def testChangeClaims(self):
+        directory = newDirectory()
+        self.marked(directory)
+        acc    = FakeAccount(directory, self.lowest)
+        idMap  = acc.idMap
+        values = idMap.readClaims(acc)
+        self.assertTrue(idMap.changeClaims(acc, values, [], ['claim x']))
+        # the serial moved on, a second change of the same values fails
+        self.assertFalse(idMap.changeClaims(acc, values, [], ['claim y']))
+        current = directory.get(CLAIMS)['description']
+        self.assertTrue('serial 4' in current and 'claim x' in current)
+        self.assertFalse('claim y' in current)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+'''Pipeline: window, error mapping and waiting for a dn; Restore adds an
+entry only after the add of its parent finished'''
+import sys
+import unittest
+import StringIO
+
+import ldap
+
+import ldapAccount
+import ldapAccount.backup
+
+class Session(object):
+    '''Asynchronous operations of a connection. An operation finishes when
+       its result is waited for, not when it is polled with timeout 0.'''
+    def __init__(self, errors=None):
+        self.msgid  = 0
+        self.dns    = {}            # msgid -> dn
+        self.errors = errors or {}  # dn -> LDAPError to answer with
+        self.log    = []            # ('submit' or 'result', dn)
+
+    def submit(self, dn):
+        self.msgid += 1
+        self.dns[self.msgid] = dn
+        self.log.append(('submit', dn))
+        return self.msgid
+
+    def ldap_add_async(self, dn, attrs):
+        return self.submit(dn)
+
+    def ldap_modify_async(self, dn, attrs):
+        return self.submit(dn)
+
+    def ldap_del_async(self, dn):
+        return self.submit(dn)
+
+    def ldap_result(self, msgid, timeout=-1):
+        if timeout == 0:
+            return None, None
+        dn = self.dns.pop(msgid)
+        self.log.append(('result', dn))
+        if dn in self.errors:
+            raise self.errors[dn]
+        return ldap.RES_ADD, []
+
+    def ldap_pipeline(self, window=64, callback=None):
+        return ldapAccount.Pipeline(self, window, callback)
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.finished = []
+
+    def callback(self, dn, tag, error):
+        self.finished.append((dn, tag, error))
+
+    def testWindow(self):
+        session  = Session()
+        pipeline = ldapAccount.Pipeline(session, 2, self.callback)
+        for name in ('a', 'b', 'c'):
+            pipeline.add('cn=' + name, [], name)
+            self.assertTrue(len(pipeline) < 2)
+        self.assertEqual([f[1] for f in self.finished], ['a', 'b'])
+        pipeline.flush()
+        self.assertEqual([f[1] for f in self.finished], ['a', 'b', 'c'])
+        self.assertEqual((pipeline.done, pipeline.errors), (3, 0))
+
+    def testErrorIsMappedToDn(self):
+        error    = ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        session  = Session({'cn=b': error})
+        pipeline = ldapAccount.Pipeline(session, 64, self.callback)
+        pipeline.add('cn=a', [])
+        pipeline.modify('cn=b', [])
+        pipeline.delete('cn=c')
+        pipeline.flush()
+        self.assertEqual(self.finished, [('cn=a', None, None),
+                                         ('cn=b', None, error),
+                                         ('cn=c', None, None)])
+        self.assertEqual((pipeline.done, pipeline.errors), (3, 1))
+
+    def testWait(self):
+        session  = Session()
+        pipeline = ldapAccount.Pipeline(session, 64, self.callback)
+        pipeline.add('ou=a', [])
+        pipeline.add('OU=B', [])
+        pipeline.add('ou=c', [])
+        pipeline.wait('ou=b')
+        self.assertEqual([f[0] for f in self.finished], ['ou=a', 'OU=B'])
+        self.assertEqual(len(pipeline), 1)
+        # nothing outstanding on it, returns at once
+        pipeline.wait('ou=d')
+        self.assertEqual(len(pipeline), 1)
+
+class RestoreTest(unittest.TestCase):
+    def restore(self, session, entries):
+        restore = ldapAccount.backup.Restore(session)
+        for dn in entries:
+            restore.add(dn, {'objectClass': ['top']})
+        restore.finish()
+        return restore
+
+    def testParentFirst(self):
+        session = Session()
+        self.restore(session, ['dc=example,dc=org',
+                               'ou=users,dc=example,dc=org',
+                               'uid=alice,ou=users,dc=example,dc=org',
+                               'uid=bob,ou=users,dc=example,dc=org'])
+        log = session.log
+        self.assertTrue(log.index(('result', 'dc=example,dc=org')) <
+                        log.index(('submit', 'ou=users,dc=example,dc=org')))
+        self.assertTrue(log.index(('result', 'ou=users,dc=example,dc=org')) <
+                        log.index(('submit',
+                                   'uid=alice,ou=users,dc=example,dc=org')))
+        # siblings do not wait for each other
+        self.assertTrue(log.index(('submit',
+                                   'uid=bob,ou=users,dc=example,dc=org')) <
+                        log.index(('result',
+                                   'uid=alice,ou=users,dc=example,dc=org')))
+
+    def testEscapedComma(self):
+        session = Session()
+        self.restore(session, ['ou=users,dc=org', 'cn=Doe\\, Jane,dc=org',
+                               'uid=jane,cn=Doe\\, Jane,dc=org'])
+        log = session.log
+        # the parent is cn=Doe\, Jane,dc=org, not the unrelated ou=users
+        self.assertTrue(log.index(('submit', 'cn=Doe\\, Jane,dc=org')) <
+                        log.index(('result', 'ou=users,dc=org')))
+        self.assertTrue(log.index(('result', 'cn=Doe\\, Jane,dc=org')) <
+                        log.index(('submit', 'uid=jane,cn=Doe\\, Jane,dc=org')))
+
+    def testCounts(self):
+        session = Session({'cn=b,dc=org':
+                           ldap.ALREADY_EXISTS({'desc': 'Already exists'}),
+                           'cn=c,dc=org':
+                           ldap.NO_SUCH_OBJECT({'desc': 'No such object'})})
+        out, stdout = StringIO.StringIO(), sys.stdout
+        sys.stdout = out
+        try:
+            restore = self.restore(session, ['cn=a,dc=org', 'cn=b,dc=org',
+                                             'cn=c,dc=org'])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(restore.counts(), (1, 1, 1))
+        self.assertEqual(out.getvalue(), 'cn=b,dc=org: Already exists\n'
+                                         'cn=c,dc=org: No such object!\n')
+
+if __name__ == '__main__':
+    unittest.main()